@@ -1,36 +1,137 @@
-import os
-from flask import Flask, request, jsonify, session, send_file
+import click
+import redis
+from hashlib import sha1
+from urllib.parse import urlencode
+from flask import (Blueprint, Flask, Request, current_app, request, jsonify,
+                   session, send_from_directory, url_for)
+from flask.cli import with_appcontext
 from flask_cors import CORS
 from flask_session import Session
-from werkzeug.security import check_password_hash, generate_password_hash
-from werkzeug.utils import secure_filename
-from config import AppConfig
-from models import get_uuid, db, User, Product, Order, Order_Item
+from werkzeug.exceptions import RequestEntityTooLarge
+from bulk import BulkError, export_response, import_upload
+from cache import cache
+from cart import carts
+from config import get_config
+from catalog import InvalidQuery, product_page, product_query
+from images import (ALLOWED_EXTENSIONS, HashedUpload, UploadTooLarge,
+                    content_etag)
+from metrics import metrics
+from models import (db, dispose_after_fork, set_sqlite_pragmas, User, Product,
+                    Order_Item)
+from passwords import HasherBusy, passwords
+from orders import CheckoutConflict, order_history, order_query, place_order
+from streaming import STREAM_BATCH, batched, stream_format, stream_response
+from search import SearchUnavailable, create_search_index, search_page
+
+
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+# Room for the text fields and multipart boundaries around an image.
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+REDIS_CLIENTS = ("SESSION_REDIS", "CACHE_REDIS", "CART_REDIS")
+
+api = Blueprint("api", __name__)
+
+
+class UploadRequest(Request):
+    """Parses multipart uploads straight into the upload folder.
+
+    Each file is hashed as werkzeug writes it, instead of being spooled
+    to a temporary file and then copied and hashed again.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return HashedUpload(current_app.config["UPLOAD_FOLDER"])
+
+
+def create_app(config=None):
+    """Build the app from a config class, or a profile name for get_config.
+
+    Nothing connects here: the engine and Redis pools open connections on
+    first use, so a preloaded parent can fork workers that each get their
+    own. Run `flask init-db` to create the schema.
+    """
+    if config is None or isinstance(config, str):
+        config = get_config(config)
+    app = Flask(__name__)
+    app.request_class = UploadRequest
+    app.config.from_object(config)
+
+    # One client, and so one connection pool, unless the config sets its
+    # own. redis-py pools start over in a forked child by themselves.
+    client = None
+    for name in REDIS_CLIENTS:
+        if app.config.get(name) is None:
+            client = client or redis.from_url(app.config["REDIS_URL"])
+            app.config[name] = client
+
+    db.init_app(app)
+    with app.app_context():
+        set_sqlite_pragmas(db.engine, app.config["SQLITE_PRAGMAS"])
+    dispose_after_fork(app)
+    cache.init_app(app)
+    carts.init_app(app)
+    metrics.init_app(app)
+    passwords.init_app(app)
+    CORS(app, supports_credentials=True,
+         expose_headers=["X-Next-Cursor", "Link"])
+    Session(app)
+
+    app.register_blueprint(api)
+    app.cli.add_command(init_db_command)
+    return app
+
+
+def init_db():
+    """Create missing tables, indexes and the search index."""
+    db.create_all()
+    # create_all skips tables that already exist, indexes and all, so
+    # indexes added to existing tables are created here.
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    create_search_index()
 
 
-UPLOAD_FOLDER = os.path.join('static', 'uploads')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    """Create missing tables, indexes and the search index."""
+    init_db()
+    click.echo("Initialized the database.")
 
-app = Flask(__name__)
-app.config.from_object(AppConfig)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-db.init_app(app)
-CORS(app, supports_credentials=True)
+def allowed_file(filename):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-Session(app)
 
-with app.app_context():
-    db.create_all()
+@api.errorhandler(HasherBusy)
+def hasher_busy(error):
+    response = jsonify({"error": "Too many logins right now, try again shortly"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
 
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def json_response(body):
+    return current_app.response_class(body, mimetype="application/json")
 
 
-@app.route("/user")
-@app.route("/user/<username>/products")
+def paginated_response(items, next_cursor, endpoint):
+    return link_next(jsonify(items), next_cursor, endpoint)
+
+
+def link_next(response, next_cursor, endpoint):
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = '<%s>; rel="next"' % url_for(
+            endpoint, **{**request.args.to_dict(), "cursor": next_cursor})
+    return response
+
+
+@api.route("/user")
+@api.route("/user/<username>/products")
 def user_session(username=None):
     if username is None:
         userId = session.get("user_id")
@@ -39,28 +140,39 @@ def user_session(username=None):
 
         user = User.query.filter_by(id=userId).first()
         if user is not None:
-            return jsonify({
-                "id": user.id,
-                "username": user.username,
-                "created": user.created
-            })
+            return jsonify(user.serialize())
         return "Error"
     else:
-        productList = []
-        user = User.query.filter_by(username=username).first()
-        products = Product.query.filter_by(user_id=user.id)
+        def find_user():
+            user = User.query.filter_by(username=username).first()
+            return None if user is None else {"id": user.id}
+
+        # Usernames never change, so the lookup needs no scope.
+        user = cache.fetch("user-id:" + username, [], find_user)
+        if user is None:
+            return jsonify({"error": "User not found"}), 404
+
+        products = Product.query.with_entities(*Product.view_columns()) \
+            .filter(Product.user_id == user["id"])
 
-        for product in products:
-            productList.append(product.serialize())
-        return productList
+        format = stream_format()
+        if format is not None:
+            products = products.order_by(Product.id).yield_per(STREAM_BATCH)
+            return stream_response(
+                map(Product.serialize_rows, batched(products)), format)
 
+        def listing():
+            return {"body": current_app.json.dumps(
+                Product.serialize_rows(products))}
 
-@app.route("/register", methods=["POST"])
+        scope = "seller:" + user["id"]
+        return json_response(cache.fetch(scope, [scope], listing)["body"])
+
+
+@api.route("/register", methods=["POST"])
 def register():
     formData = request.get_json()
 
-    print(formData)
-
     if len(formData["username"]) < 4:
         return jsonify({"error": "Username must be at least 4 characters"}), 403
 
@@ -70,21 +182,20 @@ def register():
     if check_duplicate_user is not None:
         return jsonify({"error": "Username already taken!"}), 403
 
-    haskKey = generate_password_hash(formData["password"])
+    haskKey = passwords.hash(formData["password"])
 
     user = User(username=formData["username"], hash=haskKey)
     db.session.add(user)
     db.session.commit()
 
     session["user_id"] = user.id
-    session["cart"] = []
 
     return jsonify({
         "status": "success!"
     })
 
 
-@app.route("/login", methods=["POST"])
+@api.route("/login", methods=["POST"])
 def login():
     session.clear()
 
@@ -92,20 +203,29 @@ def login():
 
     user = User.query.filter_by(username=formData["username"]).first()
 
+    # Unknown usernames get the same answer, in the same time, as wrong
+    # passwords.
     if user is None:
-        return jsonify({"error": "Incorrect Username"}), 401
-    elif not check_password_hash(user.hash, formData["password"]):
-        return jsonify({"error": "Incorrect password"}), 401
+        passwords.reject()
+        return jsonify({"error": "Incorrect username or password"}), 401
+    elif not passwords.verify(user.hash, formData["password"]):
+        return jsonify({"error": "Incorrect username or password"}), 401
+
+    try:
+        if passwords.needs_rehash(user.hash):
+            user.hash = passwords.hash(formData["password"])
+            db.session.commit()
+    except HasherBusy:
+        pass
 
     session["user_id"] = user.id
-    session["cart"] = []
 
     return jsonify({
         "status": "success"
     })
 
 
-@app.route("/logout")
+@api.route("/logout")
 def logout():
     session.clear()
     return jsonify({
@@ -113,118 +233,141 @@ def logout():
     })
 
 
-@app.route("/cart", methods=["GET", "POST"])
+@api.route("/cart")
 def cart():
-    if request.method == "GET":
-        if session["cart"] is not None:
-            return session["cart"]
-        return {
-            "status": "empty"
-        }
+    userId = session.get("user_id")
+    if userId is None:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # Prices and availability come from the database, not the cart; items
+    # sold or removed since they were added drop out of the cart.
+    ids = carts.product_ids(userId)
+    products = Product.query.with_entities(*Product.view_columns()) \
+        .filter(Product.id.in_(ids)).order_by(Product.id).all()
+
+    gone = set(ids) - {product.id for product in products}
+    carts.remove(userId, *gone)
+
+    return Product.serialize_rows(products)
 
 
-@app.route("/add-to-cart", methods=["POST"])
+@api.route("/add-to-cart", methods=["POST"])
 def add_to_cart():
-    if request.method == "POST":
-        if 'cart' in session:
-            product = request.get_json()
+    userId = session.get("user_id")
+    if userId is None:
+        return jsonify({
+            "status": "error"
+        }), 400
 
-            if product in session['cart']:
-                return jsonify({
-                    "error": "Item already in cart!"
-                }), 400
+    try:
+        productId = int(request.get_json()["id"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Invalid product"}), 400
 
-            session["cart"].append(product)
-            session.modified = True
+    if db.session.get(Product, productId) is None:
+        return jsonify({"error": "Item is no longer available"}), 404
 
-            return jsonify({
-                "status": "added"
-            })
-        else:
-            return jsonify({
-                "status": "error"
-            }), 400
+    if not carts.add(userId, productId):
+        return jsonify({
+            "error": "Item already in cart!"
+        }), 400
+
+    return jsonify({
+        "status": "added"
+    })
 
 
-@app.route("/remove-from-cart/<index>")
-def remove_from_cart(index):
-    del session['cart'][int(index)]
-    session.modified = True
+@api.route("/remove-from-cart/<int:product_id>")
+def remove_from_cart(product_id):
+    userId = session.get("user_id")
+    if userId is None:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    carts.remove(userId, product_id)
 
     return jsonify({
         "Status": "deleted"
     })
 
 
-@app.route("/checkout", methods=["POST"])
+@api.route("/checkout", methods=["POST"])
 def checkout():
-    products = request.get_json()
-    if len(products) >= 1:
-        sellToOrder = Order(user_id=session['user_id'], status="Bought")
-        db.session.add(sellToOrder)
-        db.session.commit()
-        for i in range(len(products)):
-            user = User.query.filter_by(id=products[i]['user_id']).first()
-            buyFromOrder = Order(user_id=user.id, status="Sold")
-            db.session.add(buyFromOrder)
-            db.session.commit()
-
-            order_item_buyer = Order_Item(order_id=buyFromOrder.id,
-                                          product_id=products[i]['id'], price=products[i]['price'], title=products[i]['title'], image=products[i]['image'])
+    userId = session.get("user_id")
+    if userId is None:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # With no body the whole server-side cart is bought; a list of
+    # products buys just those (e.g. "Buy" on a single product).
+    products = request.get_json(silent=True)
+    if products is None:
+        productIds = carts.product_ids(userId)
+    elif isinstance(products, list):
+        try:
+            productIds = [int(product["id"]) for product in products]
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "Invalid product in cart"}), 400
+    else:
+        return jsonify({"error": "Expected a list of products"}), 400
 
-            order_item_seller = Order_Item(order_id=buyFromOrder.id,
-                                           product_id=products[i]['id'], price=products[i]['price'], title=products[i]['title'], image=products[i]['image'])
+    if len(productIds) >= 1:
+        try:
+            place_order(userId, productIds)
+        except CheckoutConflict as e:
+            return jsonify({
+                "error": str(e),
+                "conflicts": e.conflicts
+            }), 409
 
-            db.session.add(order_item_buyer)
-            db.session.add(order_item_seller)
-            db.session.commit()
+        carts.remove(userId, *productIds)
 
-            buyFromOrder.items.append(order_item_seller)
-            sellToOrder.items.append(order_item_buyer)
+    return "Success"
 
-            product = Product.query.filter_by(id=products[i]['id']).first()
-            db.session.delete(product)
 
-            db.session.commit()
+def serialize_orders(orders):
+    orderList = []
 
-        session['cart'] = []
+    for order in orders:
+        obj = order.serialize()
+        obj['items'] = Order_Item.serialize_list(order.items, "summary")
+        orderList.append(obj)
 
-        return "Success"
+    return orderList
 
 
-@app.route("/get-orders")
+@api.route("/get-orders")
 def get_orders():
-    orders = Order.query.filter_by(user_id=session['user_id'])
+    if session.get("user_id") is None:
+        return jsonify({"error": "Unauthorized"}), 401
 
-    orderList = []
-    order_items = []
+    format = stream_format()
+    try:
+        if format is not None:
+            orders = order_query(session['user_id'], request.args) \
+                .yield_per(STREAM_BATCH)
+            return stream_response(
+                map(serialize_orders, batched(orders)), format)
 
-    for order in orders:
-        obj = {
-            "id": order.id,
-            "user_id": order.user_id,
-            "status": order.status,
-            "created": order.created,
-            "items": []
-        }
-
-        for i in range(len(order.items)):
-            item = {
-                "id": order.items[i].id,
-                "order_id": order.items[i].order_id,
-                "title": order.items[i].title,
-                "image": order.items[i].image,
-            }
-            obj['items'].append(item)
+        orders, next_cursor = order_history(session['user_id'], request.args)
+    except InvalidQuery as e:
+        return jsonify({"error": str(e)}), 400
 
-        orderList.append(obj)
-
-    return orderList
+    return paginated_response(serialize_orders(orders), next_cursor,
+                              ".get_orders")
 
 
-@app.route('/add-product', methods=["POST"])
+@api.route('/add-product', methods=["POST"])
 def add_product():
     if request.method == "POST":
+        # Otherwise werkzeug writes the whole body, whatever its size,
+        # before the upload's size can be checked.
+        request.max_content_length = \
+            current_app.config["MAX_IMAGE_SIZE"] + UPLOAD_FORM_OVERHEAD
+        try:
+            request.files
+        except RequestEntityTooLarge:
+            return jsonify({"error": "Image must be at most %d bytes"
+                            % current_app.config["MAX_IMAGE_SIZE"]}), 413
+
         if 'file' not in request.files:
             return jsonify({
                 "error": "No file part!"
@@ -242,24 +385,47 @@ def add_product():
             })
 
         if file and allowed_file(file.filename):
-            name = get_uuid()
-            file_type = file.filename.split('.')[-1]
-            file.filename = name + '.' + file_type
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+            file_type = file.filename.rsplit('.', 1)[1]
+            try:
+                filename = file.stream.save(
+                    file_type, current_app.config["MAX_IMAGE_SIZE"])
+            except UploadTooLarge as e:
+                return jsonify({"error": str(e)}), 413
 
             product = Product(user_id=session["user_id"], title=title, price=price,
                               category=category, description=description, image=filename)
 
             db.session.add(product)
             db.session.commit()
+            cache.invalidate_products([product])
 
         return jsonify({
             "status": "success"
         })
 
 
-@ app.route('/remove-product/<id>')
+@api.route("/products/bulk", methods=["GET", "POST"])
+def bulk_products():
+    userId = session.get("user_id")
+    if userId is None:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    if request.method == "GET":
+        format = request.args.get("format", "ndjson")
+        if format not in ("csv", "ndjson"):
+            return jsonify({"error": "format must be csv or ndjson"}), 400
+        return export_response(userId, format)
+
+    try:
+        report = import_upload(userId, request.mimetype, request.stream,
+                               current_app.config["UPLOAD_FOLDER"],
+                               current_app.config["MAX_IMAGE_SIZE"])
+    except BulkError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(report)
+
+
+@api.route('/remove-product/<id>')
 def remove_product(id):
     if session["user_id"]:
         product = Product.query.filter_by(id=id).first()
@@ -267,6 +433,7 @@ def remove_product(id):
         if product.user_id == session["user_id"]:
             db.session.delete(product)
             db.session.commit()
+            cache.invalidate_products([product])
             return jsonify({
                 "status": "deleted"
             })
@@ -275,24 +442,70 @@ def remove_product(id):
     }), 401
 
 
-@ app.route('/products')
-@ app.route('/products/<id>')
+@api.route('/products')
+@api.route('/products/<int:id>')
 def product(id=None):
     if id is None:
-        productList = []
-        products = Product.query.all()
-
-        for i in range(len(products)):
-            productList.append(products[i].serialize())
-        return productList
+        format = stream_format()
+        try:
+            if format is not None:
+                products, _ = product_query(request.args)
+                products = products.yield_per(STREAM_BATCH)
+                return stream_response(
+                    map(Product.serialize_rows, batched(products)), format)
+
+            def page():
+                products, next_cursor = product_page(request.args)
+                return {
+                    "body": current_app.json.dumps(
+                        Product.serialize_rows(products)),
+                    "next_cursor": next_cursor or "",
+                }
+
+            query = urlencode(sorted(request.args.items(multi=True)))
+            page = cache.fetch("catalog:" + sha1(query.encode()).hexdigest(),
+                               ["catalog"], page)
+        except InvalidQuery as e:
+            return jsonify({"error": str(e)}), 400
+
+        return link_next(json_response(page["body"]), page["next_cursor"],
+                         ".product")
     else:
-        product = Product.query.filter_by(id=id).first()
+        def detail():
+            product = Product.query.filter_by(id=id).first()
+            if product is None:
+                return None
+            return {"body": current_app.json.dumps(product.serialize())}
 
-        return product.serialize()
+        scope = "product:%d" % id
+        product = cache.fetch(scope, [scope], detail)
+        if product is None:
+            return jsonify({"error": "Product not found"}), 404
+        return json_response(product["body"])
 
 
-@ app.route('/image/<filename>', methods=["GET"])
-def get_image(filename):
-    file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+@api.route('/search')
+def search():
+    try:
+        products, next_cursor = search_page(request.args)
+    except InvalidQuery as e:
+        return jsonify({"error": str(e)}), 400
+    except SearchUnavailable:
+        return jsonify({"error": "Search is only available with SQLite"}), 501
 
-    return send_file(file_path)
+    return paginated_response(Product.serialize_rows(products),
+                              next_cursor, ".search")
+
+
+@api.route('/image/<filename>', methods=["GET"])
+def get_image(filename):
+    # Upload names are never reused, so clients may cache them forever.
+    # Content-addressed names double as strong ETags; send_from_directory
+    # answers If-None-Match with 304 and Range with 206.
+    etag = content_etag(filename)
+    response = send_from_directory(current_app.config["UPLOAD_FOLDER"],
+                                   filename, etag=etag if etag else True,
+                                   max_age=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,100 @@
+"""Onboarding a large seller: one add-product commit per item vs bulk.
+
+Times inserting N products one ORM add + commit at a time, as
+/add-product does, against importing the same rows from an NDJSON file
+through bulk.import_products. Then reports the import's peak Python
+memory at N and 4N rows, which should stay flat.
+
+    cd server
+    python -m benchmarks.bulk_import [rows]
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from bulk import ImageSource, import_products, read_rows
+from cache import cache
+from models import db, Product
+from search import create_search_index
+from benchmarks.cache import make_redis
+from benchmarks.common import temporary_app
+
+
+def write_rows(path, count, image):
+    with open(path, "w") as f:
+        for i in range(count):
+            f.write(json.dumps({
+                "title": "Product %d" % i, "price": i % 500,
+                "category": "furniture",
+                "description": "Synthetic product %d" % i,
+                "image": image}) + "\n")
+
+
+def one_by_one(count, image):
+    start = time.perf_counter()
+    for i in range(count):
+        db.session.add(Product(
+            user_id="seller", title="Product %d" % i, price=i % 500,
+            category="furniture", description="Synthetic product %d" % i,
+            image=image))
+        db.session.commit()
+    return time.perf_counter() - start
+
+
+def bulk(path, folder):
+    with open(path, "rb") as f:
+        start = time.perf_counter()
+        report = import_products("seller", read_rows(f, "ndjson"),
+                                 ImageSource(folder, 1024 * 1024))
+        elapsed = time.perf_counter() - start
+    assert report["created"] == db.session.query(Product).count(), report
+    return elapsed
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 20000
+    workdir = tempfile.mkdtemp(prefix="bulk-import-")
+    data = b"\xff\xd8\xff\xe0benchmark"
+    image = hashlib.sha256(data).hexdigest() + ".jpg"
+    with open(os.path.join(workdir, image), "wb") as f:
+        f.write(data)
+
+    def run(rows, measure):
+        path = os.path.join(workdir, "rows.ndjson")
+        write_rows(path, rows, image)
+        with temporary_app() as app:
+            app.config["CACHE_REDIS"] = make_redis()
+            cache.init_app(app)
+            with app.app_context():
+                create_search_index()
+                return measure(path)
+
+    try:
+        print("%d products" % count)
+        single = run(count, lambda path: one_by_one(count, image))
+        print("  one commit per item %8.2fs %8.0f rows/s"
+              % (single, count / single))
+        batched = run(count, lambda path: bulk(path, workdir))
+        print("  bulk import         %8.2fs %8.0f rows/s (%.0fx)"
+              % (batched, count / batched, single / batched))
+
+        def peak(path):
+            tracemalloc.start()
+            bulk(path, workdir)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak
+
+        for rows in (count, count * 4):
+            print("  peak memory, %7d rows %6.1f MiB"
+                  % (rows, run(rows, peak) / 1024 / 1024))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
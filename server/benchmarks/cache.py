@@ -0,0 +1,112 @@
+"""Read throughput of product detail and catalog pages, cache off and on.
+
+Uses the Redis at $BENCH_REDIS_URL if set, otherwise an in-process
+fakeredis server (pip install fakeredis). That database is flushed, so
+point it at a scratch one; $REDIS_URL, the app's own Redis, is never
+used. Also checks that a burst of concurrent misses recomputes the entry
+only once.
+
+    cd server
+    BENCH_REDIS_URL=redis://localhost/15 python -m benchmarks.cache [products]
+"""
+import os
+import sys
+import threading
+import time
+import redis
+from flask import json
+from sqlalchemy import insert
+from cache import Cache
+from catalog import product_page
+from models import db, Product
+from benchmarks.common import temporary_app
+
+READS = 2000
+
+
+def make_redis():
+    """A flushed Redis for benchmarks: $BENCH_REDIS_URL or fakeredis."""
+    if os.environ.get("BENCH_REDIS_URL"):
+        client = redis.from_url(os.environ["BENCH_REDIS_URL"])
+        client.flushdb()
+        return client
+    import fakeredis
+    return fakeredis.FakeRedis()
+
+
+def reads(cache, count):
+    """Alternate product detail and catalog page reads, as the routes do."""
+    def detail(id):
+        product = db.session.get(Product, id)
+        return {"body": json.dumps(product.serialize())}
+
+    def page():
+        products, next_cursor = product_page({"category": "Furniture"})
+        return {"body": json.dumps(Product.serialize_rows(products)),
+                "next_cursor": next_cursor or ""}
+
+    start = time.perf_counter()
+    for n in range(READS):
+        id = n % count + 1
+        cache.fetch("product:%d" % id, ["product:%d" % id],
+                    lambda: detail(id))
+        cache.fetch("catalog:furniture", ["catalog"], page)
+        db.session.remove()
+    return READS * 2 / (time.perf_counter() - start)
+
+
+def stampede(cache, threads=16):
+    computed = []
+    barrier = threading.Barrier(threads)
+
+    def compute():
+        computed.append(1)
+        time.sleep(0.1)
+        return {"body": "[]"}
+
+    def read():
+        barrier.wait()
+        cache.fetch("stampede", ["catalog"], compute)
+
+    workers = [threading.Thread(target=read) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return len(computed)
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 10000
+    with temporary_app() as app, app.app_context():
+        db.session.execute(insert(Product), [{
+            "user_id": "seller",
+            "title": f"product {i}",
+            "price": float(i % 100),
+            "category": ["Furniture", "Electronics"][i % 2],
+            "description": "benchmark product",
+            "image": "none.jpg",
+        } for i in range(count)])
+        db.session.commit()
+
+        off = reads(Cache(), count)
+        app.config["CACHE_REDIS"] = make_redis()
+        cache = Cache(app)
+        reads(cache, count)
+        cache.stats.clear()
+        on = reads(cache, count)
+
+        print(f"{READS * 2} reads over {count} products")
+        print(f"  cache off: {off:8.0f} reads/s")
+        print(f"  cache on:  {on:8.0f} reads/s ({on / off:.1f}x), "
+              f"{cache.stats['hit']} hits, {cache.stats['miss']} misses")
+
+        cache.invalidate("catalog")
+        computed = stampede(cache)
+        print(f"16 concurrent misses on one key: {computed} recompute(s)")
+        if computed != 1:
+            sys.exit("stampede protection failed")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,59 @@
+"""Cart write latency as the cart grows: pickled session list vs Redis hash.
+
+Uses the Redis at $BENCH_REDIS_URL if set (flushed first), otherwise
+fakeredis.
+
+    cd server
+    python -m benchmarks.cart 10 100 1000 5000
+"""
+import pickle
+import sys
+import time
+from flask import Flask
+from cart import CartStore
+from benchmarks.cache import make_redis
+
+PRODUCT = {"id": 0, "user_id": "e9de3165e46546188bcc50f067015822",
+           "title": "product", "price": 50.0, "category": "Electronics",
+           "description": "A product description of typical length",
+           "image": "393204757a914981b659da810ee63944.jpg"}
+REPEAT = 200
+
+
+def session_add(client, key, product):
+    """What add_to_cart cost with the cart in the pickled session."""
+    session = pickle.loads(client.get(key))
+    if product not in session["cart"]:
+        session["cart"].append(product)
+    client.set(key, pickle.dumps(session))
+
+
+def main(argv):
+    sizes = [int(a) for a in argv] or [10, 100, 1000, 5000]
+    client = make_redis()
+    app = Flask(__name__)
+    app.config["CART_REDIS"] = client
+    carts = CartStore(app)
+
+    print(f"{'items':>6} {'session us':>11} {'hash us':>8}")
+    for size in sizes:
+        items = [dict(PRODUCT, id=i) for i in range(size)]
+        client.set("session", pickle.dumps({"cart": items}))
+        client.delete("cart:user")
+        for i in range(size):
+            carts.add("user", i)
+
+        start = time.perf_counter()
+        for n in range(REPEAT):
+            session_add(client, "session", dict(PRODUCT, id=size + n))
+        session = (time.perf_counter() - start) / REPEAT * 1e6
+
+        start = time.perf_counter()
+        for n in range(REPEAT):
+            carts.add("user", size + n)
+        hashed = (time.perf_counter() - start) / REPEAT * 1e6
+        print(f"{size:>6} {session:>11.0f} {hashed:>8.0f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
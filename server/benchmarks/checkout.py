@@ -0,0 +1,148 @@
+"""Checkout throughput, per-item commits versus one set-based transaction.
+
+Also races several buyers for the same products and checks that exactly
+one of them gets the cart and the rest see a conflict. tests/test_checkout.py
+runs the same race under pytest.
+
+    cd server
+    python -m benchmarks.checkout [buyers] [items-per-cart]
+"""
+import sys
+import threading
+import time
+from sqlalchemy import insert
+from models import db, User, Product, Order, Order_Item
+from orders import CheckoutConflict, place_order
+from benchmarks.common import temporary_app
+
+
+def seed_products(seller_id, count, offset=0):
+    rows = [{
+        "user_id": seller_id,
+        "title": f"product {i}",
+        "price": float(i % 100),
+        "category": "Electronics",
+        "description": "benchmark product",
+        "image": "none.jpg",
+    } for i in range(offset, offset + count)]
+    db.session.execute(insert(Product), rows)
+    db.session.commit()
+
+
+def seed_users(count):
+    users = [User(username=f"user {i}", hash="x") for i in range(count)]
+    db.session.add_all(users)
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def legacy_checkout(buyer_id, products):
+    """The per-item checkout path, one commit per statement group."""
+    sellToOrder = Order(user_id=buyer_id, status="Bought")
+    db.session.add(sellToOrder)
+    db.session.commit()
+    for i in range(len(products)):
+        user = User.query.filter_by(id=products[i]['user_id']).first()
+        buyFromOrder = Order(user_id=user.id, status="Sold")
+        db.session.add(buyFromOrder)
+        db.session.commit()
+
+        order_item_buyer = Order_Item(order_id=buyFromOrder.id,
+                                      product_id=products[i]['id'], price=products[i]['price'], title=products[i]['title'], image=products[i]['image'])
+
+        order_item_seller = Order_Item(order_id=buyFromOrder.id,
+                                       product_id=products[i]['id'], price=products[i]['price'], title=products[i]['title'], image=products[i]['image'])
+
+        db.session.add(order_item_buyer)
+        db.session.add(order_item_seller)
+        db.session.commit()
+
+        buyFromOrder.items.append(order_item_seller)
+        sellToOrder.items.append(order_item_buyer)
+
+        product = Product.query.filter_by(id=products[i]['id']).first()
+        db.session.delete(product)
+
+        db.session.commit()
+
+
+def throughput(checkout, buyers, items):
+    with temporary_app() as app, app.app_context():
+        seller, *buyer_ids = seed_users(buyers + 1)
+        seed_products(seller, buyers * items)
+        carts = [p.serialize() for p in Product.query.order_by(Product.id)]
+        db.session.remove()
+
+        start = time.perf_counter()
+        for n, buyer in enumerate(buyer_ids):
+            checkout(buyer, carts[n * items:(n + 1) * items])
+        elapsed = time.perf_counter() - start
+        db.session.remove()
+        return buyers / elapsed
+
+
+def race(buyers, items):
+    """Every buyer tries to buy the same cart at once.
+
+    Returns each buyer's outcome ("ok", "conflict" or the exception it
+    raised) and the number of items sold.
+    """
+    with temporary_app() as app:
+        with app.app_context():
+            seller, *buyer_ids = seed_users(buyers + 1)
+            seed_products(seller, items)
+            ids = [id for id, in db.session.query(Product.id)]
+
+        results = []
+        barrier = threading.Barrier(buyers)
+
+        def buy(buyer):
+            with app.app_context():
+                barrier.wait()
+                try:
+                    place_order(buyer, ids)
+                    results.append("ok")
+                except CheckoutConflict:
+                    results.append("conflict")
+                except Exception as e:
+                    results.append(e)
+
+        threads = [threading.Thread(target=buy, args=(b,)) for b in buyer_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with app.app_context():
+            sold = Order_Item.query.join(Order) \
+                .filter(Order.status == "Sold").count()
+        return results, sold
+
+
+def main(argv):
+    buyers = int(argv[0]) if argv else 200
+    items = int(argv[1]) if len(argv) > 1 else 5
+
+    legacy = throughput(
+        lambda buyer, cart: legacy_checkout(buyer, cart), buyers, items)
+    current = throughput(
+        lambda buyer, cart: place_order(buyer, [p["id"] for p in cart]),
+        buyers, items)
+    print(f"{buyers} checkouts of {items} items")
+    print(f"  per-item commits: {legacy:8.1f} checkouts/s")
+    print(f"  single transaction: {current:6.1f} checkouts/s "
+          f"({current / legacy:.1f}x)")
+
+    results, sold = race(8, items)
+    errors = [r for r in results if r not in ("ok", "conflict")]
+    print(f"8 buyers racing for the same {items} items: "
+          f"{results.count('ok')} succeeded, "
+          f"{results.count('conflict')} conflicted, {len(errors)} failed, "
+          f"{sold} items sold")
+    if results.count("ok") != 1 or results.count("conflict") != 7 or \
+            len(results) != 8 or sold != items:
+        sys.exit("checkout race failed: %r" % errors)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,29 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from flask import Flask
+from models import db
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    return app
+
+
+@contextmanager
+def temporary_app():
+    """Yield a bare app bound to a fresh SQLite file with the schema created."""
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        app = make_app(path)
+        with app.app_context():
+            db.create_all()
+        yield app
+    finally:
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
@@ -0,0 +1,469 @@
+"""Reproducible load test of the API routes.
+
+Builds the app against a temporary SQLite database, upload folder and
+Redis (an in-process fakeredis TCP server unless --redis-url is given),
+seeds synthetic users, products with image files and order histories,
+then drives each route through the Flask test client and through a real
+multi-worker WSGI server. Results go to stdout (or --output) as JSON with
+throughput and p50/p95/p99 latency per route. The benchmarks need the
+development requirements (fakeredis) on top of the app's:
+
+    pip install -r requirements-dev.txt
+    cd server
+    python -m benchmarks.loadtest --output baseline.json
+    python -m benchmarks.loadtest --baseline baseline.json
+
+The run first checks that a /get-orders request runs the same number of
+SQL statements at every history size (benchmarks.order_history) and
+exits non-zero if not. With --baseline it also exits non-zero if any
+route's p95 latency or throughput is more than --tolerance worse than
+the baseline, it returns more unexpected statuses (any status its
+scenario doesn't expect), or it is missing from the run. --redis-url
+must point at a scratch database: it is flushed.
+"""
+import argparse
+import hashlib
+import http.client
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "loadtest-password"
+MODES = ("client", "server")
+
+
+class Scenario(object):
+    """One route under test; `request(n)` gives the n-th request to send.
+
+    Any response status not in `expect` counts as an error.
+    """
+
+    def __init__(self, name, request, login=False, expect=(200,)):
+        self.name = name
+        self.request = request
+        self.login = login
+        self.expect = expect
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_redis():
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(("127.0.0.1", free_port()))
+    server.daemon_threads = True
+    # Accepted sockets inherit this; without it every pipelined reply
+    # stalls ~40ms on Nagle's algorithm and delayed ACKs.
+    server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "redis://%s:%d" % server.server_address
+
+
+def seed(args, upload_folder):
+    """Fill the database and upload folder; return what the scenarios use."""
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    from models import db, get_uuid, User, Product, Order, Order_Item
+
+    rng = random.Random(args.seed)
+
+    images = []
+    for i in range(args.images):
+        data = b"\xff\xd8\xff\xe0" + rng.randbytes(args.image_size)
+        name = hashlib.sha256(data).hexdigest() + ".jpg"
+        with open(os.path.join(upload_folder, name), "wb") as f:
+            f.write(data)
+        images.append(name)
+
+    # Every user shares one hash so seeding doesn't pay the KDF per user.
+    password_hash = generate_password_hash(PASSWORD)
+    users = [{"id": get_uuid(), "username": "user%05d" % i,
+              "hash": password_hash} for i in range(args.users)]
+    db.session.execute(insert(User), users)
+
+    # Checkout deletes what it buys, so it gets its own products.
+    checkout_count = args.requests * len(MODES)
+    categories = ["Electronics", "Apparel & Accessories", "Furniture",
+                  "Health & Personal care", "Food & Beverage",
+                  "Toys & Hobbies"]
+    db.session.execute(insert(Product), [{
+        "user_id": users[i % len(users)]["id"],
+        "title": "Product %d" % i,
+        "price": float(rng.randint(1, 500)),
+        "category": categories[i % len(categories)],
+        "description": "Synthetic product %d for load testing" % i,
+        "image": images[i % len(images)],
+    } for i in range(args.products + checkout_count)])
+
+    db.session.execute(insert(Order), [{
+        "user_id": user["id"], "status": "Bought",
+    } for user in users for _ in range(args.orders)])
+    order_ids = [id for id, in db.session.query(Order.id)]
+    db.session.execute(insert(Order_Item), [{
+        "order_id": order_id, "title": "Product", "price": 1.0,
+        "image": images[order_id % len(images)],
+    } for order_id in order_ids for _ in range(2)])
+    db.session.commit()
+
+    ids = [id for id, in db.session.query(Product.id).order_by(Product.id)]
+    return {
+        "usernames": [user["username"] for user in users],
+        "products": ids[:args.products],
+        "checkout": ids[args.products:],
+        "images": images,
+        "cart": itertools.count(),
+    }
+
+
+def scenarios(fixture, seed):
+    rng = random.Random(seed)
+    products = fixture["products"]
+    checkout = iter(fixture["checkout"])
+    lock = threading.Lock()
+
+    def next_checkout(n):
+        with lock:
+            return ("POST", "/checkout", [{"id": next(checkout)}])
+
+    def next_cart_item(n):
+        # Shared by both modes' scenarios, so no cart gets a product twice.
+        with lock:
+            id = products[next(fixture["cart"]) % len(products)]
+        return ("POST", "/add-to-cart", {"id": id})
+
+    def login(n):
+        username = fixture["usernames"][n % len(fixture["usernames"])]
+        return ("POST", "/login",
+                {"username": username, "password": PASSWORD})
+
+    return [
+        Scenario("GET /products", lambda n: (
+            "GET", "/products?limit=50" if n % 2 else
+            "/products?limit=50&category=Furniture&sort=-price", None)),
+        Scenario("GET /products/<id>", lambda n: (
+            "GET", "/products/%d" % rng.choice(products), None)),
+        Scenario("GET /get-orders", lambda n: (
+            "GET", "/get-orders", None), login=True),
+        Scenario("POST /add-to-cart", next_cart_item, login=True),
+        Scenario("POST /checkout", next_checkout, login=True),
+        Scenario("POST /login", login),
+        Scenario("GET /image/<filename>", lambda n: (
+            "GET", "/image/" + fixture["images"][n % len(fixture["images"])],
+            None)),
+    ]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] \
+            * 1000
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def run_client(app, fixture, tests, count):
+    """Drive every scenario sequentially through the Flask test client."""
+    results = {}
+    for n, scenario in enumerate(tests):
+        client = app.test_client()
+        if scenario.login:
+            client.post("/login", json={
+                "username": fixture["usernames"][n % len(fixture["usernames"])],
+                "password": PASSWORD})
+
+        latencies, errors = [], 0
+        start = time.perf_counter()
+        for i in range(count):
+            method, path, body = scenario.request(i)
+            began = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            response.get_data()
+            latencies.append(time.perf_counter() - began)
+            errors += response.status_code not in scenario.expect
+        results[scenario.name] = summarize(
+            latencies, errors, time.perf_counter() - start)
+    return results
+
+
+class HttpClient(object):
+    """A keep-alive HTTP client that carries the session cookie."""
+
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def request(self, method, path, body=None):
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        try:
+            self.conn.request(method, path, body=data, headers=headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port,
+                                                   timeout=60)
+            return 599
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return response.status
+
+
+def start_server(kind, workers, port, env, log, threads=1, config=None):
+    """Start the app on `port`; `config` runs gunicorn from a config file,
+    overriding only its worker count and address."""
+    if kind == "gunicorn" and config:
+        command = [sys.executable, "-m", "gunicorn", "--config", config,
+                   "--workers", str(workers),
+                   "--bind", "127.0.0.1:%d" % port]
+    elif kind == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "--workers",
+                   str(workers), "--threads", str(threads),
+                   "--bind", "127.0.0.1:%d" % port, "app:create_app()"]
+    else:
+        # werkzeug can't combine threads with processes.
+        command = [sys.executable, "-c",
+                   "from werkzeug.serving import run_simple\n"
+                   "from app import create_app\n"
+                   "run_simple('127.0.0.1', %d, create_app(), threaded=%r, "
+                   "processes=%d)" % (port, threads > 1,
+                                      1 if threads > 1 else workers)]
+    process = subprocess.Popen(command, cwd=SERVER_DIR, env=env,
+                               stdout=log, stderr=log)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited with %d" % process.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("server did not start")
+
+
+def warm_up(port, workers):
+    """Send requests until every worker has booted and served some.
+
+    The listening socket accepts before workers finish importing the app,
+    so without this the first route measured absorbs their startup.
+    """
+    def hit():
+        client = HttpClient(port)
+        for _ in range(5):
+            client.request("GET", "/products?limit=1")
+
+    threads = [threading.Thread(target=hit) for _ in range(workers * 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_server(port, fixture, tests, count, concurrency):
+    """Drive every scenario from `concurrency` threads over real HTTP."""
+    results = {}
+    for scenario in tests:
+        clients = [HttpClient(port) for _ in range(concurrency)]
+        if scenario.login:
+            for n, client in enumerate(clients):
+                client.request("POST", "/login", {
+                    "username": fixture["usernames"][
+                        n % len(fixture["usernames"])],
+                    "password": PASSWORD})
+
+        counter = itertools.count()
+        latencies, statuses = [], []
+
+        def work(client):
+            while True:
+                i = next(counter)
+                if i >= count:
+                    return
+                method, path, body = scenario.request(i)
+                began = time.perf_counter()
+                statuses.append(client.request(method, path, body))
+                latencies.append(time.perf_counter() - began)
+
+        threads = [threading.Thread(target=work, args=(client,))
+                   for client in clients]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        errors = sum(status not in scenario.expect for status in statuses)
+        results[scenario.name] = summarize(
+            latencies, errors, time.perf_counter() - start)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of every regression against `baseline`."""
+    regressions = []
+    for mode, routes in baseline["results"].items():
+        for route, before in routes.items():
+            name = "%s %s" % (mode, route)
+            after = results["results"].get(mode, {}).get(route)
+            if after is None:
+                regressions.append("%s: missing from this run" % name)
+                continue
+            if after["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                regressions.append("%s: p95 %.1fms -> %.1fms" % (
+                    name, before["p95_ms"], after["p95_ms"]))
+            if after["throughput"] < before["throughput"] * (1 - tolerance):
+                regressions.append("%s: throughput %.0f/s -> %.0f/s" % (
+                    name, before["throughput"], after["throughput"]))
+            if after["errors"] > before["errors"]:
+                regressions.append("%s: errors %d -> %d" % (
+                    name, before["errors"], after["errors"]))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mode", choices=MODES + ("both",), default="both")
+    parser.add_argument("--server", choices=("gunicorn", "werkzeug"),
+                        default="gunicorn" if shutil.which("gunicorn")
+                        else "werkzeug")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=300,
+                        help="requests per route and mode")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--orders", type=int, default=20,
+                        help="order history length per user")
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--image-size", type=int, default=50 * 1024)
+    parser.add_argument("--profile", default="production",
+                        help="APP_ENV to run the app with")
+    parser.add_argument("--redis-url")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    upload_folder = os.path.join(workdir, "uploads")
+    os.mkdir(upload_folder)
+
+    redis_server = None
+    if args.redis_url:
+        redis_url = args.redis_url
+    else:
+        redis_server, redis_url = start_fake_redis()
+
+    # config.py reads these when it is first imported, here and in the
+    # server processes.
+    env = dict(os.environ,
+               APP_ENV=args.profile,
+               DATABASE_URL="sqlite:///" + os.path.join(workdir, "store.db"),
+               UPLOAD_FOLDER=upload_folder,
+               REDIS_URL=redis_url)
+    env.setdefault("SECRET_KEY", "loadtest")
+    os.environ.update(env)
+
+    server = None
+    failures = []
+    try:
+        import redis
+        redis.from_url(redis_url).flushdb()
+
+        # First, since it builds apps of its own and the extensions keep
+        # the app they were last initialised with.
+        from benchmarks import order_history
+        try:
+            checks = {"get_orders_statements": order_history.check()}
+        except AssertionError as e:
+            checks = {}
+            failures.append(str(e))
+
+        from app import create_app, init_db
+        app = create_app()
+        with app.app_context():
+            init_db()
+            fixture = seed(args, upload_folder)
+
+        report = {
+            "config": {k: v for k, v in vars(args).items()
+                       if k not in ("output", "baseline", "redis_url")},
+            "checks": checks,
+            "results": {},
+        }
+        if args.mode in ("client", "both"):
+            tests = scenarios(fixture, args.seed)
+            report["results"]["client"] = run_client(
+                app, fixture, tests, args.requests)
+        if args.mode in ("server", "both"):
+            port = free_port()
+            log = open(os.path.join(workdir, "server.log"), "w")
+            server = start_server(args.server, args.workers, port, env, log)
+            warm_up(port, args.workers)
+            tests = scenarios(
+                dict(fixture, checkout=fixture["checkout"][args.requests:]),
+                args.seed)
+            report["results"]["server"] = run_server(
+                port, fixture, tests, args.requests, args.concurrency)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if redis_server is not None:
+            redis_server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    problems = ["CHECK FAILED " + failure for failure in failures]
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        problems += ["REGRESSION " + regression for regression
+                     in compare(report, baseline, args.tolerance)]
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
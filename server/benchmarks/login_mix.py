@@ -0,0 +1,142 @@
+"""Catalog latency under a login storm, hashing inline and in the pool.
+
+Serves the app from gunicorn with the shipped gunicorn.conf.py (threaded
+workers) against a seeded temporary database and fakeredis, as
+benchmarks.loadtest does. For each
+hashing mode it measures GET /products latency on its own, then again
+while other clients log in as fast as they can:
+
+    cd server
+    python -m benchmarks.login_mix [catalog-requests]
+
+Inline is PASSWORD_HASH_WORKERS=0. 503s are logins turned away by the
+pool's queue limit. --threads sets GUNICORN_THREADS; with 1 (sync-like
+workers) a login blocks its whole worker while it waits for the pool.
+"""
+import argparse
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.loadtest import (PASSWORD, HttpClient, free_port, seed,
+                                 start_fake_redis, start_server, summarize,
+                                 warm_up)
+
+WORKERS = 2
+CATALOG_CLIENTS = 2
+LOGIN_CLIENTS = 8
+MODES = (("inline", "0"), ("pool", "1"))
+
+
+def catalog(port, count, logins=None):
+    """Time `count` catalog reads, optionally with a login storm going."""
+    stop = threading.Event()
+    login_statuses = []
+
+    def log_in(n):
+        client = HttpClient(port)
+        for i in itertools.count():
+            if stop.is_set():
+                return
+            username = logins[(n + i) % len(logins)]
+            login_statuses.append(client.request(
+                "POST", "/login",
+                {"username": username, "password": PASSWORD}))
+
+    stormers = [threading.Thread(target=log_in, args=(n,))
+                for n in range(LOGIN_CLIENTS if logins else 0)]
+    for thread in stormers:
+        thread.start()
+    if stormers:
+        time.sleep(1)
+
+    counter = itertools.count()
+    latencies, statuses = [], []
+
+    def read():
+        client = HttpClient(port)
+        while next(counter) < count:
+            began = time.perf_counter()
+            statuses.append(client.request("GET", "/products?limit=50"))
+            latencies.append(time.perf_counter() - began)
+
+    readers = [threading.Thread(target=read) for _ in range(CATALOG_CLIENTS)]
+    start = time.perf_counter()
+    for thread in readers:
+        thread.start()
+    for thread in readers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    for thread in stormers:
+        thread.join()
+    result = summarize(latencies, sum(s != 200 for s in statuses), elapsed)
+    return result, login_statuses
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("count", type=int, nargs="?", default=500)
+    parser.add_argument("--threads", type=int)
+    args = parser.parse_args(argv)
+    count = args.count
+    workdir = tempfile.mkdtemp(prefix="login-mix-")
+    upload_folder = os.path.join(workdir, "uploads")
+    os.mkdir(upload_folder)
+    redis_server, redis_url = start_fake_redis()
+    env = dict(os.environ,
+               APP_ENV="production",
+               DATABASE_URL="sqlite:///" + os.path.join(workdir, "store.db"),
+               UPLOAD_FOLDER=upload_folder,
+               REDIS_URL=redis_url)
+    env.setdefault("SECRET_KEY", "login-mix")
+    if args.threads:
+        env["GUNICORN_THREADS"] = str(args.threads)
+    os.environ.update(env)
+
+    try:
+        from app import create_app, init_db
+        app = create_app()
+        with app.app_context():
+            init_db()
+            fixture = seed(argparse.Namespace(
+                seed=0, users=50, requests=0, products=5000, orders=0,
+                images=5, image_size=1024), upload_folder)
+
+        print("%d catalog reads from %d clients, %d login clients, "
+              "gunicorn.conf.py with %d workers x %s threads" % (
+                  count, CATALOG_CLIENTS, LOGIN_CLIENTS, WORKERS,
+                  env.get("GUNICORN_THREADS", "default")))
+        for name, workers in MODES:
+            port = free_port()
+            log = open(os.path.join(workdir, name + ".log"), "w")
+            server = start_server(
+                "gunicorn", WORKERS, port,
+                dict(env, PASSWORD_HASH_WORKERS=workers), log,
+                config="gunicorn.conf.py")
+            try:
+                warm_up(port, WORKERS)
+                alone, _ = catalog(port, count)
+                mixed, logins = catalog(port, count, fixture["usernames"])
+            finally:
+                server.terminate()
+                server.wait()
+                log.close()
+
+            for label, result in (("alone", alone), ("with logins", mixed)):
+                print("%-6s %-12s p50 %7.1fms  p99 %7.1fms  %6.0f req/s" % (
+                    name, label, result["p50_ms"], result["p99_ms"],
+                    result["throughput"]))
+            print("%-6s logins: %d ok, %d rejected with 503" % (
+                name, logins.count(200), logins.count(503)))
+    finally:
+        redis_server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
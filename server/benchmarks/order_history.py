@@ -0,0 +1,115 @@
+"""Queries and latency per /get-orders request as a user's history grows.
+
+Each request goes through the whole app (session, route, serialization)
+with the Flask test client, and every SQL statement it runs is counted.
+The count must not depend on how many orders the user has; the run
+fails if it does. benchmarks.loadtest runs check() too.
+
+    cd server
+    python -m benchmarks.order_history 10 100 1000 10000
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import event, insert
+from benchmarks.cache import make_redis
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+from app import create_app, init_db  # noqa: E402
+from config import AppConfig  # noqa: E402
+from models import db, User, Order, Order_Item  # noqa: E402
+
+ITEMS_PER_ORDER = 3
+REPEAT = 20
+
+
+def seed(user_id, count):
+    start = datetime(2023, 1, 1)
+    db.session.execute(insert(Order), [{
+        "user_id": user_id,
+        "status": "Bought",
+        "created": start + timedelta(minutes=i),
+    } for i in range(count)])
+    ids = [id for id, in db.session.query(Order.id)]
+    db.session.execute(insert(Order_Item), [{
+        "order_id": order_id,
+        "title": f"item {n}",
+        "image": "none.jpg",
+        "price": 1.0,
+    } for order_id in ids for n in range(ITEMS_PER_ORDER)])
+    db.session.commit()
+
+
+def make_config(path):
+    class Config(AppConfig):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + path
+        SESSION_REDIS = CACHE_REDIS = CART_REDIS = make_redis()
+        PASSWORD_HASH_WORKERS = 0
+    return Config
+
+
+def run(count):
+    """Return (statements per request, ms per request) for `count` orders."""
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        app = create_app(make_config(path))
+        with app.app_context():
+            init_db()
+            user = User(username="buyer", hash="x")
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+            seed(user_id, count)
+            db.session.remove()
+
+            statements = []
+            event.listen(db.engine, "before_cursor_execute",
+                         lambda *args: statements.append(1))
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["user_id"] = user_id
+
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            response = client.get("/get-orders")
+            assert response.status_code == 200, response.status_code
+            assert len(response.get_json()) == min(count, 50)
+        elapsed = (time.perf_counter() - start) / REPEAT * 1000
+
+        with app.app_context():
+            db.engine.dispose()
+        return len(statements) / REPEAT, elapsed
+    finally:
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def check(sizes=(10, 100, 1000)):
+    """Statements per /get-orders request by history size; raises
+    AssertionError if they differ."""
+    counts = {count: run(count)[0] for count in sizes}
+    assert len(set(counts.values())) == 1, \
+        "/get-orders statements grow with order history: %r" % counts
+    return counts
+
+
+def main(argv):
+    sizes = [int(a) for a in argv] or [10, 100, 1000, 10000]
+    print(f"{'orders':>8} {'queries':>8} {'ms/req':>8}")
+    counts = set()
+    for count in sizes:
+        queries, elapsed = run(count)
+        counts.add(queries)
+        print(f"{count:>8} {queries:>8g} {elapsed:>8.2f}")
+    if len(counts) > 1:
+        sys.exit("query count grows with order history")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
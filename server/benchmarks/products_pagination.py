@@ -0,0 +1,71 @@
+"""Latency of one /products page as the catalog grows.
+
+Seeds a throwaway SQLite database at each size and times the first page,
+a page deep in the catalog and a filtered, price-sorted page. With the
+keyset cursor and composite indexes every column should stay flat.
+
+    cd server
+    python -m benchmarks.products_pagination 1000 10000 100000 1000000
+"""
+import sys
+import time
+from sqlalchemy import insert
+from catalog import encode_cursor, product_page
+from models import db, User, Product
+from benchmarks.common import temporary_app
+
+CATEGORIES = ["Electronics", "Apparel & Accessories", "Furniture",
+              "Health & Personal care", "Food & Beverage", "Toys & Hobbies"]
+REPEAT = 50
+
+
+def seed(count, batch=10000):
+    user = User(username="seller", hash="x")
+    db.session.add(user)
+    db.session.commit()
+    for start in range(0, count, batch):
+        rows = [{
+            "user_id": user.id,
+            "title": f"product {i}",
+            "price": float((i * 7919) % 1000),
+            "category": CATEGORIES[i % len(CATEGORIES)],
+            "description": "benchmark product",
+            "image": "none.jpg",
+        } for i in range(start, min(start + batch, count))]
+        db.session.execute(insert(Product), rows)
+        db.session.commit()
+
+
+def time_page(args):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        product_page(args)
+        db.session.remove()
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+
+def run(count):
+    with temporary_app() as app, app.app_context():
+        seed(count)
+        return {
+            "first": time_page({}),
+            "deep": time_page({"cursor": encode_cursor([count // 2])}),
+            "filtered": time_page({
+                "category": "Furniture", "min_price": "100",
+                "max_price": "900", "sort": "-price",
+                "cursor": encode_cursor([500.0, count // 2]),
+            }),
+        }
+
+
+def main(argv):
+    sizes = [int(a) for a in argv] or [1000, 10000, 100000, 1000000]
+    print(f"{'rows':>10} {'first ms':>10} {'deep ms':>10} {'filtered ms':>12}")
+    for count in sizes:
+        r = run(count)
+        print(f"{count:>10} {r['first']:>10.2f} {r['deep']:>10.2f} "
+              f"{r['filtered']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
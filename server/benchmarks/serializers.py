@@ -0,0 +1,57 @@
+"""Serializing a large product list: per-call inspect() versus cached views.
+
+    cd server
+    python -m benchmarks.serializers [products]
+
+"inspect()" is the old Serializer, which walks every attribute including
+the orders relationship and so lazy-loads it once per product.
+"""
+import sys
+import time
+from sqlalchemy import insert, select
+from sqlalchemy.inspection import inspect
+from models import db, Product
+from benchmarks.common import temporary_app
+
+
+def legacy_serialize(product):
+    d = {c: getattr(product, c) for c in inspect(product).attrs.keys()}
+    del d['orders']
+    return d
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    db.session.remove()
+    print(f"  {label:<28} {elapsed:8.3f}s")
+    return result
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 100000
+    with temporary_app() as app, app.app_context():
+        db.session.execute(insert(Product), [{
+            "user_id": "seller",
+            "title": f"product {i}",
+            "price": float(i % 100),
+            "category": "Electronics",
+            "description": "benchmark product",
+            "image": "none.jpg",
+        } for i in range(count)])
+        db.session.commit()
+
+        print(f"serializing {count} products")
+        old = timed("inspect() per object",
+                    lambda: [legacy_serialize(p) for p in Product.query])
+        new = timed("cached view, ORM objects",
+                    lambda: Product.serialize_list(Product.query))
+        rows = timed("cached view, core rows",
+                     lambda: Product.serialize_rows(db.session.execute(
+                         select(*Product.view_columns()))))
+        assert old == new == rows
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,110 @@
+"""Multi-process SQLite write contention, default settings vs production.
+
+Each worker process inserts rows one transaction at a time while as many
+reader processes query the table, all against one database file. Reports
+write and read throughput and how many transactions failed with
+"database is locked" (the default profile waits at most pysqlite's 5
+seconds).
+
+    cd server
+    python -m benchmarks.sqlite_writes [processes] [writes-per-process]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from sqlalchemy import create_engine, insert, select, func
+from sqlalchemy.exc import OperationalError
+from config import AppConfig, ProductionConfig
+from models import db, set_sqlite_pragmas, Product
+
+
+def make_engine(path, config):
+    engine = create_engine("sqlite:///" + path,
+                           **getattr(config, "SQLALCHEMY_ENGINE_OPTIONS", {}))
+    set_sqlite_pragmas(engine, config.SQLITE_PRAGMAS)
+    return engine
+
+
+def writer(path, config, worker, writes, results):
+    engine = make_engine(path, config)
+    locked = 0
+    for n in range(writes):
+        try:
+            with engine.begin() as conn:
+                conn.execute(insert(Product.__table__), {
+                    "user_id": "seller", "title": f"product {worker}-{n}",
+                    "price": 1.0, "category": "Electronics",
+                    "description": "benchmark", "image": "none.jpg"})
+        except OperationalError:
+            locked += 1
+    results.put(locked)
+
+
+def reader(path, config, stop, reads):
+    engine = make_engine(path, config)
+    done = 0
+    while not stop.is_set():
+        try:
+            with engine.connect() as conn:
+                conn.execute(select(func.count()).select_from(
+                    Product.__table__)).scalar()
+            done += 1
+        except OperationalError:
+            pass
+    reads.put(done)
+
+
+def run(config, processes, writes):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        engine = make_engine(path, config)
+        db.metadata.create_all(engine)
+        engine.dispose()
+
+        results = multiprocessing.Queue()
+        reads = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        readers = [multiprocessing.Process(target=reader,
+                                           args=(path, config, stop, reads))
+                   for _ in range(processes)]
+        writers = [multiprocessing.Process(
+            target=writer, args=(path, config, n, writes, results))
+            for n in range(processes)]
+        for process in readers:
+            process.start()
+
+        start = time.perf_counter()
+        for process in writers:
+            process.start()
+        locked = sum(results.get() for _ in writers)
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        read = sum(reads.get() for _ in readers)
+        for process in readers + writers:
+            process.join()
+        committed = processes * writes - locked
+        return committed / elapsed, read / elapsed, locked
+    finally:
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def main(argv):
+    processes = int(argv[0]) if argv else 4
+    writes = int(argv[1]) if len(argv) > 1 else 500
+    print(f"{processes} writer and {processes} reader processes, "
+          f"{writes} single-row transactions per writer")
+    for name, config in (("default", AppConfig),
+                         ("production", ProductionConfig)):
+        writes_per_s, reads_per_s, locked = run(config, processes, writes)
+        print(f"  {name:<10} {writes_per_s:8.0f} commits/s "
+              f"{reads_per_s:8.0f} reads/s, {locked} locked")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
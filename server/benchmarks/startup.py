@@ -0,0 +1,154 @@
+"""Import and startup time, and memory shared between gunicorn workers.
+
+Times `import app` and going from a cold interpreter to a served
+request, each in a fresh process. Then runs gunicorn with N workers,
+once with every worker loading the app itself and once preloaded from
+gunicorn.conf.py, and reads each worker's /proc/<pid>/smaps_rollup
+(Linux only) after it has served traffic. USS is the memory that is
+private to one worker; PSS splits shared pages between the processes
+that share them.
+
+    cd server
+    python -m benchmarks.startup [workers]
+
+--app selects the WSGI target, e.g. app:app for a tree without the
+factory.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import shutil
+import time
+from benchmarks.common import make_app
+from benchmarks.loadtest import (SERVER_DIR, free_port, seed,
+                                 start_fake_redis, warm_up)
+
+RUNS = 9
+
+
+def timed(code, env):
+    """Best wall time of running `code` in a new interpreter."""
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=SERVER_DIR,
+                       env=env, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def serve_code(target):
+    module, _, expression = target.partition(":")
+    return ("import %s\n"
+            "application = eval(%r, vars(%s))\n"
+            "response = application.test_client().get('/products?limit=1')\n"
+            "assert response.status_code == 200\n"
+            % (module, expression, module))
+
+
+def smaps(pid):
+    values = {}
+    with open("/proc/%d/smaps_rollup" % pid) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1])
+    return values
+
+
+def workers_of(pid):
+    with open("/proc/%d/task/%d/children" % (pid, pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+def memory(target, workers, options, env, log):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--workers", str(workers),
+         "--bind", "127.0.0.1:%d" % port] + options + [target],
+        cwd=SERVER_DIR, env=env, stdout=log, stderr=log)
+    try:
+        deadline = time.monotonic() + 60
+        while len(workers_of(server.pid)) < workers:
+            if time.monotonic() > deadline or server.poll() is not None:
+                raise RuntimeError("gunicorn did not start")
+            time.sleep(0.1)
+        time.sleep(1)
+        for _ in range(4):
+            warm_up(port, workers)
+        samples = [smaps(pid) for pid in workers_of(server.pid)]
+        master = smaps(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    def mean(field):
+        return sum(field(sample) for sample in samples) / len(samples) / 1024
+
+    return {
+        "rss": mean(lambda s: s["Rss"]),
+        "pss": mean(lambda s: s["Pss"]),
+        "uss": mean(lambda s: s["Private_Clean"] + s["Private_Dirty"]),
+        "total_pss": (sum(s["Pss"] for s in samples) + master["Pss"]) / 1024,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("workers", type=int, nargs="?", default=4)
+    parser.add_argument("--app", default="app:create_app()")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="startup-")
+    upload_folder = os.path.join(workdir, "uploads")
+    os.mkdir(upload_folder)
+    redis_server, redis_url = start_fake_redis()
+    path = os.path.join(workdir, "store.db")
+    env = dict(os.environ,
+               APP_ENV="production",
+               DATABASE_URL="sqlite:///" + path,
+               UPLOAD_FOLDER=upload_folder,
+               REDIS_URL=redis_url)
+    env.setdefault("SECRET_KEY", "startup")
+    os.environ.update(env)
+
+    try:
+        from models import db
+        from search import create_search_index
+        with make_app(path).app_context():
+            db.create_all()
+            create_search_index()
+            seed(argparse.Namespace(
+                seed=0, users=20, requests=0, products=2000, orders=5,
+                images=5, image_size=1024), upload_folder)
+
+        baseline = timed("pass", env)
+        print("%s, best of %d fresh interpreters (minus %.0fms startup)"
+              % (args.app, RUNS, baseline * 1000))
+        print("  import app            %6.0fms"
+              % ((timed("import app", env) - baseline) * 1000))
+        print("  first request served  %6.0fms"
+              % ((timed(serve_code(args.app), env) - baseline) * 1000))
+
+        modes = [("import per worker", ["--config", os.devnull])]
+        if os.path.exists(os.path.join(SERVER_DIR, "gunicorn.conf.py")):
+            modes.append(("preloaded", ["--config", "gunicorn.conf.py"]))
+        print("%d gunicorn workers, MiB per worker" % args.workers)
+        log = open(os.path.join(workdir, "gunicorn.log"), "w")
+        for name, options in modes:
+            result = memory(args.app, args.workers, options, env, log)
+            print("  %-18s RSS %5.1f  PSS %5.1f  USS %5.1f  "
+                  "(all processes PSS %5.1f)" % (
+                      name, result["rss"], result["pss"], result["uss"],
+                      result["total_pss"]))
+        log.close()
+    finally:
+        redis_server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,360 @@
+import csv
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+import zipfile
+from functools import partial
+from flask import Response, current_app, stream_with_context
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from cache import cache
+from images import (ALLOWED_EXTENSIONS, CHUNK_SIZE, CONTENT_NAME,
+                    UploadTooLarge, save_upload)
+from models import db, Product
+from streaming import NDJSON, STREAM_BATCH, batched, stream_response
+
+
+# Columns of an import or export row, in CSV header order.
+FIELDS = Product.serialize_fields("bulk")
+UPDATED_FIELDS = ("price", "category", "description", "image")
+
+# Rows per multi-row INSERT, each committed on its own.
+IMPORT_BATCH = 500
+# Per-row errors listed in the report; later ones are only counted.
+MAX_REPORTED_ERRORS = 1000
+# Longest accepted NDJSON line, in characters.
+MAX_LINE = 64 * 1024
+
+CSV = "text/csv"
+ZIP = "application/zip"
+FORMATS = {CSV: "csv", NDJSON: "ndjson", ZIP: "zip"}
+
+
+class BulkError(ValueError):
+    """The upload as a whole can't be imported."""
+
+
+class RowError(ValueError):
+    """One row is invalid; the rest of the import carries on."""
+
+
+def read_rows(stream, format):
+    """Return an iterator of (row number, row) from a CSV or NDJSON byte
+    stream.
+
+    The CSV header or the first NDJSON line is read here, so an upload
+    that can't be imported at all (no title column, not UTF-8) raises
+    BulkError before any row is written. The rest is parsed one row at a
+    time as it's iterated; a later unreadable part raises BulkError from
+    the iterator. NDJSON rows that aren't JSON objects come out as
+    RowErrors for the caller to report.
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    try:
+        if format == "csv":
+            reader = csv.DictReader(text)
+            try:
+                fieldnames = reader.fieldnames
+            except csv.Error as e:
+                raise BulkError("Line 1: %s" % e)
+            if not fieldnames or "title" not in fieldnames:
+                raise BulkError("CSV header must include title")
+            return _csv_rows(text, reader)
+        return _ndjson_rows(text, text.readline(MAX_LINE))
+    except UnicodeDecodeError:
+        text.detach()
+        raise BulkError("Upload must be UTF-8")
+    except BulkError:
+        text.detach()
+        raise
+
+
+def _csv_rows(text, reader):
+    try:
+        for row in reader:
+            yield reader.line_num, row
+    except csv.Error as e:
+        raise BulkError("Line %d: %s" % (reader.line_num, e))
+    except UnicodeDecodeError:
+        raise BulkError("Upload must be UTF-8")
+    finally:
+        text.detach()
+
+
+def _ndjson_rows(text, line):
+    number = 0
+    try:
+        while line:
+            number += 1
+            if len(line) == MAX_LINE and not line.endswith("\n"):
+                while True:
+                    rest = text.readline(MAX_LINE)
+                    if not rest or rest.endswith("\n"):
+                        break
+                yield number, RowError("Row is longer than %d characters"
+                                       % MAX_LINE)
+            elif line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, RowError("Row is not valid JSON")
+            line = text.readline(MAX_LINE)
+    except UnicodeDecodeError:
+        raise BulkError("Upload must be UTF-8")
+    finally:
+        text.detach()
+
+
+class ImageSource(object):
+    """Resolves a row's image to the name of a stored upload.
+
+    References are either an already stored content-addressed name
+    (`<sha256>.<ext>`, as exported) or, for zip uploads, an entry in the
+    archive. Archive images are stored the first time a row uses them.
+    """
+
+    def __init__(self, folder, max_size, archive=None):
+        self.folder = folder
+        self.max_size = max_size
+        self.archive = archive
+        self.stored = {}
+
+    def resolve(self, reference):
+        extension = reference.rsplit(".", 1)[-1].lower() \
+            if "." in reference else ""
+        if extension not in ALLOWED_EXTENSIONS:
+            raise RowError("image must be one of: %s"
+                           % ", ".join(sorted(ALLOWED_EXTENSIONS)))
+
+        if reference in self.stored:
+            return self.stored[reference]
+        if self.archive is not None:
+            try:
+                info = self.archive.getinfo(reference)
+            except KeyError:
+                pass
+            else:
+                try:
+                    with self.archive.open(info) as image:
+                        filename = save_upload(image, extension, self.folder,
+                                               self.max_size)
+                except UploadTooLarge as e:
+                    raise RowError(str(e))
+                except (zipfile.BadZipFile, NotImplementedError):
+                    raise RowError("image %s can't be read from the archive"
+                                   % reference)
+                self.stored[reference] = filename
+                return filename
+
+        if CONTENT_NAME.match(reference) and \
+                os.path.exists(os.path.join(self.folder, reference)):
+            return reference
+        raise RowError("image %s not found" % reference)
+
+
+def _text(row, name, max_length, required=False):
+    value = row.get(name)
+    if value is None or value == "":
+        if required:
+            raise RowError("%s is required" % name)
+        return ""
+    if not isinstance(value, str):
+        raise RowError("%s must be a string" % name)
+    value = value.strip()
+    if len(value) > max_length:
+        raise RowError("%s must be at most %d characters"
+                       % (name, max_length))
+    return value
+
+
+def clean_row(row, images):
+    """Validate a parsed row, returning the Product column values."""
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError("Row must be an object")
+
+    values = {
+        "title": _text(row, "title", 50, required=True),
+        "category": _text(row, "category", 50),
+        "description": _text(row, "description", 120),
+    }
+    if not values["title"]:
+        raise RowError("title is required")
+
+    price = row.get("price")
+    try:
+        if isinstance(price, bool):
+            raise TypeError()
+        price = float(price)
+    except (TypeError, ValueError):
+        raise RowError("price must be a number")
+    if not math.isfinite(price) or price < 0:
+        raise RowError("price must be zero or more")
+    values["price"] = price
+
+    # Last, so images are only stored for otherwise valid rows.
+    values["image"] = images.resolve(_text(row, "image", 100, required=True))
+    return values
+
+
+def _upsert(rows):
+    """Insert `rows`, updating products of the same seller with a taken
+    title, and return (id, title, user_id) of every row written.
+
+    Passing the rows as parameters lets SQLAlchemy send them as one
+    multi-row INSERT with a statement it compiles only once.
+    """
+    if db.session.get_bind().dialect.name == "postgresql":
+        # Imported here: it's slow to import and only needed on PostgreSQL.
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        insert = sqlite.insert
+    statement = insert(Product)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Product.title],
+        set_={name: statement.excluded[name] for name in UPDATED_FIELDS},
+        where=Product.user_id == statement.excluded.user_id)
+    return db.session.execute(
+        statement.returning(Product.id, Product.title, Product.user_id),
+        rows).all()
+
+
+def _write_batch(user_id, pending, report, fail):
+    owners = dict(db.session.query(Product.title, Product.user_id)
+                  .filter(Product.title.in_(list(pending))))
+    rows = []
+    for title, (number, values) in pending.items():
+        if owners.get(title, user_id) != user_id:
+            fail(number, "title is already used by another seller")
+        else:
+            rows.append(dict(values, user_id=user_id))
+    if not rows:
+        return
+
+    try:
+        written = _upsert(rows)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        current_app.logger.exception("Bulk import batch failed")
+        for row in rows:
+            fail(pending[row["title"]][0], "Row could not be saved")
+        return
+
+    # Titles another seller claimed since `owners` was read are skipped
+    # by the upsert's WHERE and missing here.
+    titles = {product.title for product in written}
+    for row in rows:
+        if row["title"] not in titles:
+            fail(pending[row["title"]][0],
+                 "title is already used by another seller")
+        elif row["title"] in owners:
+            report["updated"] += 1
+        else:
+            report["created"] += 1
+    # New products have nothing cached under their own scope yet.
+    cache.invalidate("catalog", "seller:%s" % user_id, *[
+        "product:%s" % product.id for product in written
+        if product.title in owners])
+
+
+def import_products(user_id, rows, images, batch_size=IMPORT_BATCH):
+    """Upsert the seller's products from (row number, row) pairs.
+
+    Rows are validated as they arrive and written in multi-row INSERT
+    batches, each in its own transaction, so a bad row only fails itself
+    and memory holds a batch at most. A title the seller already uses
+    updates that product.
+    """
+    report = {"created": 0, "updated": 0, "failed": 0, "errors": []}
+
+    def fail(number, message):
+        report["failed"] += 1
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append({"row": number, "error": message})
+
+    pending = {}
+    try:
+        for number, row in rows:
+            try:
+                values = clean_row(row, images)
+            except RowError as e:
+                fail(number, str(e))
+                continue
+            # A repeated title must update the row written before it.
+            if values["title"] in pending:
+                _write_batch(user_id, pending, report, fail)
+                pending = {}
+            pending[values["title"]] = (number, values)
+            if len(pending) >= batch_size:
+                _write_batch(user_id, pending, report, fail)
+                pending = {}
+    except BulkError as e:
+        # Everything before the unreadable part is still imported.
+        report["error"] = str(e)
+    if pending:
+        _write_batch(user_id, pending, report, fail)
+    return report
+
+
+def import_upload(user_id, mimetype, stream, folder, max_image_size):
+    """Import a CSV, NDJSON or zip request body; see import_products.
+
+    A zip holds one .csv or .ndjson manifest whose image column names
+    entries of the same archive. It's spooled to a temporary file first,
+    since reading an archive needs to seek.
+    """
+    format = FORMATS.get(mimetype)
+    if format is None:
+        raise BulkError("Send %s" % ", ".join(sorted(FORMATS)))
+    if format != "zip":
+        return import_products(
+            user_id, read_rows(stream, format),
+            ImageSource(folder, max_image_size))
+
+    with tempfile.TemporaryFile() as spool:
+        shutil.copyfileobj(stream, spool, CHUNK_SIZE)
+        try:
+            archive = zipfile.ZipFile(spool)
+        except zipfile.BadZipFile:
+            raise BulkError("Upload is not a valid zip archive")
+        with archive:
+            manifests = [name for name in archive.namelist()
+                         if name.lower().endswith((".csv", ".ndjson"))]
+            if len(manifests) != 1:
+                raise BulkError("Archive must hold exactly one .csv or "
+                                ".ndjson file")
+            manifest = manifests[0]
+            with archive.open(manifest) as rows:
+                return import_products(
+                    user_id,
+                    read_rows(rows, manifest.rsplit(".", 1)[1].lower()),
+                    ImageSource(folder, max_image_size, archive))
+
+
+def export_response(user_id, format):
+    """Stream the seller's products in the import format."""
+    products = Product.query.with_entities(*Product.view_columns("bulk")) \
+        .filter(Product.user_id == user_id) \
+        .order_by(Product.id).yield_per(STREAM_BATCH)
+    batches = map(partial(Product.serialize_rows, view="bulk"),
+                  batched(products))
+    if format == "ndjson":
+        return stream_response(batches, format)
+
+    def lines():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, FIELDS)
+        writer.writeheader()
+        for batch in batches:
+            writer.writerows(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(lines()), mimetype=CSV)
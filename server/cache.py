@@ -0,0 +1,142 @@
+import secrets
+import time
+from collections import Counter
+from flask import current_app
+from redis import RedisError, WatchError
+
+
+class Cache(object):
+    """Read-through cache of serialized responses in Redis.
+
+    Entries are Redis hashes of strings. Each key belongs to one or more
+    scopes (e.g. "catalog", "product:4"); a scope's version number is part
+    of the key, so invalidating a scope is a single INCR and stale entries
+    simply age out through their TTL. Concurrent misses on the same key
+    are collapsed: one request recomputes while the others wait for it.
+    The recompute lock holds a random token, so a holder that outlived
+    the lock's timeout can't release a lock another request has taken.
+    """
+
+    def __init__(self, app=None):
+        self.redis = None
+        self.stats = Counter()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = app.config.get("CACHE_REDIS")
+        self.ttl = app.config.get("CACHE_TTL", 300)
+        self.lock_timeout = app.config.get("CACHE_LOCK_TIMEOUT", 5)
+        app.extensions["cache"] = self
+
+    def _key(self, name, scopes):
+        if not scopes:
+            return "cache:" + name
+        versions = self.redis.mget(["cache:version:" + s for s in scopes])
+        return "cache:%s:%s" % (
+            name, ".".join(v.decode() if v else "0" for v in versions))
+
+    def fetch(self, name, scopes, compute):
+        """Return the cached mapping for `name`, computing it on a miss.
+
+        `compute` returns a dict of strings to cache, or None for a result
+        that must not be cached (e.g. not found).
+        """
+        if self.redis is None:
+            return compute()
+
+        owner = False
+        token = secrets.token_hex(16)
+        try:
+            key = self._key(name, scopes)
+            value = self.redis.hgetall(key)
+            if value:
+                self.stats["hit"] += 1
+                return _decode(value)
+            self.stats["miss"] += 1
+
+            lock = "lock:" + key
+            owner = self.redis.set(lock, token, nx=True,
+                                   px=int(self.lock_timeout * 1000))
+            if not owner:
+                value = self._wait_for(key, lock)
+                if value:
+                    self.stats["wait"] += 1
+                    return _decode(value)
+        except RedisError:
+            self.stats["error"] += 1
+            return compute()
+
+        try:
+            value = compute()
+            if value is not None:
+                with self.redis.pipeline() as pipe:
+                    pipe.hset(key, mapping=value)
+                    pipe.expire(key, self.ttl)
+                    pipe.execute()
+        except RedisError:
+            self.stats["error"] += 1
+        finally:
+            if owner:
+                self._release(lock, token)
+        return value
+
+    def _release(self, lock, token):
+        """Delete `lock` if it still holds our `token`."""
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.watch(lock)
+                if pipe.get(lock) == token.encode():
+                    pipe.multi()
+                    pipe.delete(lock)
+                    pipe.execute()
+        except WatchError:
+            # The lock expired and was taken while we checked it.
+            pass
+        except RedisError:
+            self.stats["error"] += 1
+
+    def _wait_for(self, key, lock):
+        """Poll until the lock holder stores `key` or gives up."""
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.005
+        while time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+            value = self.redis.hgetall(key)
+            if value or not self.redis.exists(lock):
+                return value
+        return None
+
+    def invalidate(self, *scopes):
+        if self.redis is None or not scopes:
+            return
+        try:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for scope in scopes:
+                    pipe.incr("cache:version:" + scope)
+                pipe.execute()
+        except RedisError:
+            # The write is already committed; entries of these scopes
+            # stay stale until their TTL runs out.
+            self.stats["error"] += 1
+            current_app.logger.exception(
+                "Cache invalidation failed for %s", ", ".join(scopes))
+
+    def invalidate_products(self, products):
+        """Invalidate everything derived from `products`.
+
+        Takes anything with `id` and `user_id`: models or result rows.
+        """
+        scopes = {"catalog"}
+        for product in products:
+            scopes.add("product:%s" % product.id)
+            scopes.add("seller:%s" % product.user_id)
+        self.invalidate(*sorted(scopes))
+
+
+def _decode(value):
+    return {k.decode(): v.decode() for k, v in value.items()}
+
+
+cache = Cache()
@@ -0,0 +1,38 @@
+class CartStore(object):
+    """Shopping carts kept server-side as one Redis hash per user.
+
+    Fields are product ids, so adding, removing and membership checks
+    each touch a single field no matter how large the cart is. Only ids
+    are stored; prices and availability are read from the database when
+    the cart is shown or bought.
+    """
+
+    def __init__(self, app=None):
+        self.redis = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = app.config["CART_REDIS"]
+        app.extensions["carts"] = self
+
+    @staticmethod
+    def _key(user_id):
+        return "cart:" + user_id
+
+    def add(self, user_id, product_id):
+        """Add a product, returning False if it was already in the cart."""
+        return bool(self.redis.hsetnx(self._key(user_id), product_id, 1))
+
+    def remove(self, user_id, *product_ids):
+        if product_ids:
+            self.redis.hdel(self._key(user_id), *product_ids)
+
+    def contains(self, user_id, product_id):
+        return bool(self.redis.hexists(self._key(user_id), product_id))
+
+    def product_ids(self, user_id):
+        return sorted(int(id) for id in self.redis.hkeys(self._key(user_id)))
+
+
+carts = CartStore()
@@ -0,0 +1,171 @@
+import base64
+import json
+import math
+from sqlalchemy import and_, false, or_
+from models import User, Product
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# SQLite's INTEGER range; larger ints can't be bound as parameters.
+MAX_INTEGER = 2 ** 63 - 1
+
+# sort name -> (key columns, descending)
+SORTS = {
+    "id": (("id",), False),
+    "-id": (("id",), True),
+    "price": (("price", "id"), False),
+    "-price": (("price", "id"), True),
+}
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _cursor_value(value, type):
+    allowed = (int, float) if type is float else type
+    if isinstance(value, bool) or not isinstance(value, allowed):
+        return False
+    if isinstance(value, int):
+        return abs(value) <= MAX_INTEGER
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return True
+
+
+def decode_cursor(token, types=None):
+    """Decode a cursor token into its list of values.
+
+    With `types`, the list must hold exactly one value of each, in order,
+    so crafted cursors can't bind anything else into the query; float
+    also accepts ints, and bools are never numbers.
+    """
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise InvalidQuery("Invalid cursor")
+    if not isinstance(values, list):
+        raise InvalidQuery("Invalid cursor")
+    if types is not None:
+        if len(values) != len(types):
+            raise InvalidQuery("Cursor does not match sort order")
+        if not all(map(_cursor_value, values, types)):
+            raise InvalidQuery("Invalid cursor")
+    return values
+
+
+def _float_arg(args, name):
+    value = args.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise InvalidQuery(f"{name} must be a number")
+
+
+def page_size(args):
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise InvalidQuery("limit must be an integer")
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def keyset_filter(columns, values, descending):
+    """Keyset predicate for rows strictly after `values` in sort order.
+
+    Spelled out as nested OR/AND rather than a row-value comparison, with
+    a redundant bound on the leading column so the planner can seek into
+    the composite index instead of filtering the rows before the cursor.
+    """
+    column, rest = columns[0], columns[1:]
+    value = values[0]
+    beyond = column < value if descending else column > value
+    if not rest:
+        return beyond
+    bound = column <= value if descending else column >= value
+    return and_(bound, or_(beyond, and_(column == value,
+                                        keyset_filter(rest, values[1:],
+                                                      descending))))
+
+
+def apply_filters(query, args):
+    """Narrow a Product query by the catalog filters in `args`."""
+    category = args.get("category")
+    if category and category != "all":
+        query = query.filter(Product.category == category)
+
+    min_price = _float_arg(args, "min_price")
+    if min_price is not None:
+        query = query.filter(Product.price >= min_price)
+    max_price = _float_arg(args, "max_price")
+    if max_price is not None:
+        query = query.filter(Product.price <= max_price)
+
+    seller = args.get("seller")
+    if seller:
+        user = User.query.filter_by(username=seller).first()
+        if user is None:
+            return query.filter(false())
+        query = query.filter(Product.user_id == user.id)
+
+    return query
+
+
+def product_query(args):
+    """Product rows matching `args`, sorted and starting after the cursor.
+
+    `args` is the request's query string: `category`, `min_price`,
+    `max_price`, `seller`, `sort` (one of SORTS) and `cursor`. Rows hold
+    Product.view_columns() for Product.serialize_rows(). Also returns the
+    names of the sort key columns.
+    """
+    sort = args.get("sort", "id")
+    if sort not in SORTS:
+        raise InvalidQuery(f"sort must be one of {', '.join(SORTS)}")
+    names, descending = SORTS[sort]
+    columns = [getattr(Product, name) for name in names]
+
+    query = Product.query.with_entities(*Product.view_columns())
+
+    # The cursor predicate goes first: SQLite seeks on the first bound it
+    # sees for a column, and the cursor is usually tighter than the price
+    # filters.
+    cursor = args.get("cursor")
+    if cursor:
+        values = decode_cursor(
+            cursor, [column.type.python_type for column in columns])
+        query = query.filter(keyset_filter(columns, values, descending))
+
+    query = apply_filters(query, args)
+
+    order = [c.desc() for c in columns] if descending else columns
+    return query.order_by(*order), names
+
+
+def product_page(args):
+    """Return one page of product rows and the cursor for the next page.
+
+    Takes product_query()'s arguments plus `limit`.
+    """
+    limit = page_size(args)
+    query, names = product_query(args)
+
+    # Fetch one extra row to learn whether another page exists.
+    products = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        last = products[-1]
+        next_cursor = encode_cursor([getattr(last, name) for name in names])
+
+    return products, next_cursor
@@ -1,6 +1,5 @@
 from dotenv import load_dotenv
 import os
-import redis
 
 load_dotenv()
 
@@ -9,9 +8,70 @@ class AppConfig:
     SECRET_KEY = os.environ["SECRET_KEY"]
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_ECHO = True
-    SQLALCHEMY_DATABASE_URI = r"sqlite:///store.db"
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL",
+                                             r"sqlite:///store.db")
+    # PRAGMA name -> value, run on every new SQLite connection.
+    SQLITE_PRAGMAS = {}
     SESSION_TYPE = "redis"
     SESSION_PERMANENT = False
     SESSION_USE_SIGNER = True
-    SESSION_REDIS = redis.from_url("redis://127.0.0.1:6379")
+    REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
+    # Redis clients; create_app fills in any left as None with one client
+    # for REDIS_URL.
+    SESSION_REDIS = None
+    CACHE_REDIS = None
+    CACHE_TTL = 300
+    CART_REDIS = None
+    UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER",
+                                   os.path.join("static", "uploads"))
+    MAX_IMAGE_SIZE = 5 * 1024 * 1024
+    # werkzeug hash method and cost; hashes made with anything else are
+    # upgraded on the user's next login.
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD",
+                                          "scrypt:32768:8:1")
+    # Hashing processes per app process (0 hashes in the request thread),
+    # and how many more hashes may wait before logins get a 503. Together
+    # they must stay below gunicorn's threads per worker.
+    PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 1))
+    PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", 2))
+    PASSWORD_HASH_NICE = 10
+    PASSWORD_HASH_TIMEOUT = 30
+    # Requests running more SQL statements than this are flagged as N+1s.
+    METRICS_QUERY_THRESHOLD = 20
+
+
+class DevelopmentConfig(AppConfig):
+    SQLALCHEMY_ECHO = True
+
+
+class ProductionConfig(AppConfig):
+    # WAL lets readers run alongside the single writer, and NORMAL only
+    # fsyncs at checkpoints, which is still safe against corruption in WAL
+    # mode. Writers wait up to busy_timeout for the lock instead of
+    # failing with "database is locked".
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "temp_store": "MEMORY",
+    }
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": int(os.environ.get("DATABASE_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DATABASE_MAX_OVERFLOW", 20)),
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+    }
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "production": ProductionConfig,
+}
+
+
+def get_config(name=None):
+    """The config class for `name`, defaulting to $APP_ENV or development."""
+    return CONFIGS[name or os.environ.get("APP_ENV", "development")]
@@ -0,0 +1,30 @@
+"""gunicorn settings; run `gunicorn` from this directory to serve the API.
+
+The app is built once in the master and every worker forks from it, so
+imports and setup happen once and the workers share those pages
+copy-on-write. The engine and Redis pools reconnect in each worker.
+
+Workers are threaded: a login waiting on the password hashing pool ties
+up one thread, not the whole worker, so other routes keep being served.
+Keep PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE below `threads`, so
+logins past that get a 503 while threads are still free.
+"""
+import gc
+import multiprocessing
+import os
+
+wsgi_app = "app:create_app()"
+bind = os.environ.get("BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY",
+                             multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before any worker is
+    # forked. Frozen objects are skipped by the cyclic collector, which
+    # would otherwise write to every one of them in each worker and so
+    # copy the pages they live on.
+    gc.freeze()
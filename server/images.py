@@ -0,0 +1,90 @@
+import hashlib
+import os
+import re
+import tempfile
+
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+
+CHUNK_SIZE = 64 * 1024
+
+# Stored uploads are named by the SHA-256 of their content.
+CONTENT_NAME = re.compile(r"^([0-9a-f]{64})\.[a-z0-9]+$")
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def save_upload(stream, extension, folder, max_size):
+    """Store an upload under the hash of its content and return the name.
+
+    The stream is copied to a temporary file in `folder` while it is
+    hashed, and abandoned as soon as it passes `max_size` bytes. Identical
+    images end up as one file, however many products use them.
+    """
+    upload = HashedUpload(folder)
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            upload.write(chunk)
+            if upload.size > max_size:
+                raise UploadTooLarge(
+                    "Image must be at most %d bytes" % max_size)
+        return upload.save(extension, max_size)
+    finally:
+        upload.close()
+
+
+class HashedUpload(object):
+    """A temporary file in `folder` that hashes what is written to it.
+
+    Used as werkzeug's stream for multipart uploads (see
+    app.UploadRequest), so a file is hashed as it streams to disk and
+    save() only has to rename it. Closing it deletes the file unless it
+    was saved.
+    """
+
+    def __init__(self, folder):
+        fd, self.path = tempfile.mkstemp(dir=folder, prefix=".upload-")
+        self.file = os.fdopen(fd, "w+b")
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        # read, seek and the rest of the file interface.
+        return getattr(self.file, name)
+
+    def save(self, extension, max_size):
+        """Move the file to its content-addressed name and return it."""
+        if self.size > max_size:
+            raise UploadTooLarge("Image must be at most %d bytes" % max_size)
+        self.file.close()
+        # mkstemp creates files only we can read; static servers serving
+        # the upload folder directly need to read them too.
+        os.chmod(self.path, 0o644)
+
+        folder = os.path.dirname(self.path)
+        filename = "%s.%s" % (self.digest.hexdigest(), extension.lower())
+        path = os.path.join(folder, filename)
+        if not os.path.exists(path):
+            os.replace(self.path, path)
+        return filename
+
+    def close(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def content_etag(filename):
+    """The content hash for content-addressed names, else None."""
+    match = CONTENT_NAME.match(filename)
+    return match.group(1) if match else None
@@ -0,0 +1,198 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from flask import Response, current_app, g, has_app_context, request
+from sqlalchemy import event
+from models import db
+
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+BUCKET_LABELS = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """Per-route request timings, SQL and Redis counts for Prometheus.
+
+    Every request records its latency, the number and total time of SQL
+    statements it ran and its Redis round trips. Requests running more
+    than METRICS_QUERY_THRESHOLD statements are counted and logged as
+    likely N+1s. Everything is served in Prometheus text format at
+    /metrics. Counts are per worker process.
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.requests = defaultdict(int)
+        self.queries = defaultdict(int)
+        self.query_seconds = defaultdict(float)
+        self.redis_calls = defaultdict(int)
+        self.suspects = defaultdict(int)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.threshold = app.config.get("METRICS_QUERY_THRESHOLD", 20)
+
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute",
+                         self._before_cursor_execute)
+            event.listen(db.engine, "after_cursor_execute",
+                         self._after_cursor_execute)
+
+        clients = {}
+        for name in ("SESSION_REDIS", "CACHE_REDIS", "CART_REDIS"):
+            client = app.config.get(name)
+            if client is not None:
+                clients[id(client)] = client
+        for client in clients.values():
+            self._count_redis(client)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule("/metrics", "metrics", self.render)
+        app.extensions["metrics"] = self
+
+    @staticmethod
+    def _before_request():
+        g.metrics = {"start": time.perf_counter(), "queries": 0,
+                     "query_seconds": 0.0, "redis_calls": 0}
+
+    @staticmethod
+    def _current():
+        return g.get("metrics") if has_app_context() else None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        conn.info["query_start"] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"]
+        current = self._current()
+        if current is not None:
+            current["queries"] += 1
+            current["query_seconds"] += elapsed
+
+    def _count_redis(self, client):
+        """Count every command and pipeline sent through `client`."""
+        def counted(call):
+            def wrapper(*args, **kwargs):
+                current = self._current()
+                if current is not None:
+                    current["redis_calls"] += 1
+                return call(*args, **kwargs)
+            return wrapper
+
+        make_pipeline = client.pipeline
+
+        def pipeline(*args, **kwargs):
+            pipe = make_pipeline(*args, **kwargs)
+            pipe.execute = counted(pipe.execute)
+            return pipe
+
+        client.execute_command = counted(client.execute_command)
+        client.pipeline = pipeline
+
+    def _after_request(self, response):
+        current = g.pop("metrics", None)
+        if current is None:
+            return response
+
+        elapsed = time.perf_counter() - current["start"]
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        key = (route, request.method)
+
+        with self.lock:
+            self.latency[key].observe(elapsed)
+            self.requests[key + (str(response.status_code),)] += 1
+            self.queries[key] += current["queries"]
+            self.query_seconds[key] += current["query_seconds"]
+            self.redis_calls[key] += current["redis_calls"]
+            if current["queries"] > self.threshold:
+                self.suspects[key] += 1
+
+        if current["queries"] > self.threshold:
+            current_app.logger.warning(
+                "%s %s ran %d SQL statements, likely an N+1 query",
+                request.method, route, current["queries"])
+        return response
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append("%s%s{%s} %s" % (name, suffix, ",".join(
+                    '%s="%s"' % (k, _escape(v)) for k, v in labels), value))
+
+        def by_route(counts):
+            return [("", (("route", route), ("method", method)), value)
+                    for (route, method), value in sorted(counts.items())]
+
+        with self.lock:
+            latency = []
+            for (route, method), histogram in sorted(self.latency.items()):
+                labels = (("route", route), ("method", method))
+                cumulative = 0
+                for bound, count in zip(BUCKET_LABELS, histogram.counts):
+                    cumulative += count
+                    latency.append(("_bucket", labels + (("le", bound),),
+                                    cumulative))
+                latency.append(("_sum", labels, histogram.sum))
+                latency.append(("_count", labels, cumulative))
+            family("http_request_duration_seconds", "histogram",
+                   "Request latency by route.", latency)
+
+            family("http_requests_total", "counter",
+                   "Requests by route and status.",
+                   [("", (("route", route), ("method", method),
+                          ("status", status)), value)
+                    for (route, method, status), value
+                    in sorted(self.requests.items())])
+            family("db_queries_total", "counter",
+                   "SQL statements run by route.", by_route(self.queries))
+            family("db_query_duration_seconds_total", "counter",
+                   "Time spent in SQL statements by route.",
+                   by_route(self.query_seconds))
+            family("redis_round_trips_total", "counter",
+                   "Redis commands and pipelines sent by route.",
+                   by_route(self.redis_calls))
+            family("n_plus_one_suspect_requests_total", "counter",
+                   "Requests over the SQL statement threshold by route.",
+                   by_route(self.suspects))
+
+        cache = current_app.extensions.get("cache")
+        if cache is not None:
+            family("cache_requests_total", "counter",
+                   "Read-through cache lookups by result.",
+                   [("", (("result", result),), count)
+                    for result, count in sorted(cache.stats.items())])
+
+        return Response("\n".join(lines) + "\n",
+                        mimetype="text/plain; version=0.0.4")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+metrics = Metrics()
@@ -1,6 +1,10 @@
+import os
+import weakref
 from flask_sqlalchemy import SQLAlchemy
 from uuid import uuid4
 from datetime import datetime
+from operator import attrgetter
+from sqlalchemy import event
 from sqlalchemy.inspection import inspect
 
 db = SQLAlchemy()
@@ -10,14 +14,94 @@ def get_uuid():
     return uuid4().hex
 
 
-class Serializer(object):
+def set_sqlite_pragmas(engine, pragmas):
+    """Run `PRAGMA name = value` on every new connection to a SQLite engine."""
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+
+def dispose_after_fork(app):
+    """Drop pooled connections a process inherits when it is forked.
+
+    A preloaded parent may have opened connections before forking
+    workers; sharing their sockets between processes corrupts them. The
+    child forgets them without closing them, leaving the parent's intact,
+    and opens its own on first use.
+    """
+    app = weakref.ref(app)
 
-    def serialize(self):
-        return {c: getattr(self, c) for c in inspect(self).attrs.keys()}
+    def dispose():
+        if app() is None:
+            return
+        with app().app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+    os.register_at_fork(after_in_child=dispose)
+
+
+class Serializer(object):
+    """Serialize models to dicts of column values.
+
+    The default view is every column not in `serialize_exclude`;
+    `serialize_views` names narrower field sets. Field lists are worked
+    out once per class and view, and relationships are never read, so
+    serializing can't trigger lazy loads.
+    """
+
+    serialize_exclude = ()
+    serialize_views = {}
+
+    _serializers = {}
+
+    @classmethod
+    def serialize_fields(cls, view=None):
+        return cls._serializer(view)[0]
+
+    @classmethod
+    def _serializer(cls, view):
+        key = (cls, view)
+        if key not in Serializer._serializers:
+            if view is None:
+                fields = tuple(attr.key for attr in inspect(cls).column_attrs
+                               if attr.key not in cls.serialize_exclude)
+            else:
+                fields = tuple(cls.serialize_views[view])
+            getter = attrgetter(*fields)
+            if len(fields) == 1:
+                getter = lambda obj, get=getter: (get(obj),)
+            Serializer._serializers[key] = (fields, getter)
+        return Serializer._serializers[key]
+
+    def serialize(self, view=None):
+        fields, getter = self._serializer(view)
+        return dict(zip(fields, getter(self)))
+
+    @classmethod
+    def view_columns(cls, view=None):
+        """Columns to select to get rows for serialize_rows(view)."""
+        return [getattr(cls, field) for field in cls.serialize_fields(view)]
+
+    @classmethod
+    def serialize_rows(cls, rows, view=None):
+        """Serialize result rows without building ORM objects.
+
+        Rows must start with view_columns(view), in order; any trailing
+        columns are ignored.
+        """
+        fields = cls.serialize_fields(view)
+        return [dict(zip(fields, row)) for row in rows]
 
     @staticmethod
-    def serialize_list(l):
-        return [m.serialize() for m in l]
+    def serialize_list(l, view=None):
+        return [m.serialize(view) for m in l]
 
 
 class User(db.Model, Serializer):
@@ -30,13 +114,10 @@ class User(db.Model, Serializer):
     created = db.Column(db.DateTime, nullable=False,
                         default=datetime.utcnow)
 
-    def serialize(self):
-        d = Serializer.serialize(self)
-        del d['hash']
-        return d
+    serialize_exclude = ('hash',)
 
 
-class Order(db.Model):
+class Order(db.Model, Serializer):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(32), db.ForeignKey(
         'user.id'))
@@ -45,25 +126,27 @@ class Order(db.Model):
     created = db.Column(db.DateTime, nullable=False,
                         default=datetime.utcnow)
 
-    def serialize(self):
-        d = Serializer.serialize(self)
-        return d
+    # Order history is paged newest first per user; also serves lookups
+    # by user_id alone.
+    __table_args__ = (
+        db.Index('ix_order_user_id_created_id', 'user_id', 'created', 'id'),
+    )
 
 
-class Order_Item(db.Model):
+class Order_Item(db.Model, Serializer):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), index=True)
     image = db.Column(db.String(100))
     title = db.Column(db.String(50))
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
     price = db.Column(db.Float)
 
-    def serialize(self):
-        d = Serializer.serialize(self)
-        return d
+    serialize_views = {
+        "summary": ("id", "order_id", "title", "image"),
+    }
 
 
-class Product(db.Model):
+class Product(db.Model, Serializer):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(32), db.ForeignKey(
         'user.id'))
@@ -74,7 +157,16 @@ class Product(db.Model):
     image = db.Column(db.String(100))
     orders = db.relationship('Order_Item', backref='product', lazy=True)
 
-    def serialize(self):
-        d = Serializer.serialize(self)
-        del d['orders']
-        return d
+    serialize_views = {
+        # Columns of a bulk import or export row.
+        "bulk": ("title", "price", "category", "description", "image"),
+    }
+
+    # Composite indexes backing the keyset pagination in catalog.py; the
+    # trailing id column makes every sort order total.
+    __table_args__ = (
+        db.Index('ix_product_price_id', 'price', 'id'),
+        db.Index('ix_product_category_id', 'category', 'id'),
+        db.Index('ix_product_category_price_id', 'category', 'price', 'id'),
+        db.Index('ix_product_user_id_id', 'user_id', 'id'),
+    )
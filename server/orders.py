@@ -0,0 +1,115 @@
+from datetime import datetime
+from sqlalchemy import delete, insert
+from sqlalchemy.orm import selectinload
+from cache import cache
+from catalog import (InvalidQuery, decode_cursor, encode_cursor, keyset_filter,
+                     page_size)
+from models import db, Product, Order, Order_Item
+
+
+class CheckoutConflict(Exception):
+
+    def __init__(self, conflicts):
+        super().__init__("Some items are no longer available")
+        self.conflicts = conflicts
+
+
+def place_order(buyer_id, product_ids):
+    """Buy `product_ids` for `buyer_id` in a single transaction.
+
+    The products are claimed with one DELETE ... RETURNING, so of two
+    buyers racing for the same product exactly one gets the row back.
+    If any product is already gone nothing is written and
+    CheckoutConflict lists the missing ids. Otherwise one "Bought" order
+    is created for the buyer and one "Sold" order per item for its
+    seller, priced from the database rather than the client. Returns the
+    id of the "Bought" order.
+    """
+    product_ids = sorted(set(product_ids))
+
+    try:
+        claimed = db.session.execute(
+            delete(Product)
+            .where(Product.id.in_(product_ids))
+            .returning(Product.id, Product.user_id, Product.title,
+                       Product.price, Product.image)
+        ).all()
+
+        if len(claimed) != len(product_ids):
+            found = {row.id for row in claimed}
+            raise CheckoutConflict([
+                {"id": id, "error": "Item is no longer available"}
+                for id in product_ids if id not in found
+            ])
+
+        # One multi-row INSERT for the orders and one executemany for the
+        # items, so the statement count doesn't grow with the cart.
+        orders = [{"user_id": buyer_id, "status": "Bought"}] + [
+            {"user_id": row.user_id, "status": "Sold"} for row in claimed]
+        created = db.session.execute(
+            insert(Order).values(orders)
+            .returning(Order.id, Order.user_id, Order.status)).all()
+        # RETURNING order isn't guaranteed, but ids are handed out in
+        # VALUES order while this transaction holds the write lock.
+        created.sort(key=lambda order: order.id)
+        if [(order.user_id, order.status) for order in created] != \
+                [(order["user_id"], order["status"]) for order in orders]:
+            raise RuntimeError("Order ids were not assigned in order")
+        order_ids = [order.id for order in created]
+        bought_id = order_ids[0]
+
+        # product_id is left unset as the product row no longer exists.
+        items = []
+        for row, sold_id in zip(claimed, order_ids[1:]):
+            item = {"price": row.price, "title": row.title,
+                    "image": row.image}
+            items.append(dict(item, order_id=bought_id))
+            items.append(dict(item, order_id=sold_id))
+        db.session.execute(insert(Order_Item), items)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    cache.invalidate_products(claimed)
+
+    return bought_id
+
+
+def order_query(user_id, args):
+    """A user's orders, newest first, starting after `args['cursor']`.
+
+    Items are fetched with a select-in query per batch of orders rather
+    than lazily per order. The cursor is keyed on (created, id).
+    """
+    query = Order.query.filter_by(user_id=user_id) \
+        .options(selectinload(Order.items))
+
+    cursor = args.get("cursor")
+    if cursor:
+        values = decode_cursor(cursor)
+        try:
+            created, id = datetime.fromisoformat(values[0]), int(values[1])
+        except (IndexError, TypeError, ValueError):
+            raise InvalidQuery("Invalid cursor")
+        query = query.filter(
+            keyset_filter([Order.created, Order.id], [created, id], True))
+
+    return query.order_by(Order.created.desc(), Order.id.desc())
+
+
+def order_history(user_id, args):
+    """Return one page of a user's orders with their items.
+
+    A page costs two queries however many orders it holds.
+    """
+    limit = page_size(args)
+    orders = order_query(user_id, args).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        last = orders[-1]
+        next_cursor = encode_cursor([last.created.isoformat(), last.id])
+
+    return orders, next_cursor
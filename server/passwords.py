@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# Hashing processes are started by a single-threaded fork server rather
+# than forked from the app process: forking a threaded process (gthread
+# workers, test clients) can leave the child stuck on a lock another
+# thread held, and would run the app's after-fork hooks in it too.
+START_METHOD = "forkserver" \
+    if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are already running or queued."""
+
+
+def _lower_priority(niceness):
+    if niceness:
+        os.nice(niceness)
+
+
+class PasswordHasher(object):
+    """Password hashing and checking off the request thread.
+
+    Hashes run in a small process pool at a lower CPU priority, so a burst
+    of logins can't starve the GIL or the cores serving other routes. At
+    most PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE hashes are in flight
+    per app process; past that HasherBusy is raised straight away instead
+    of letting requests pile up. PASSWORD_HASH_WORKERS = 0 hashes inline.
+
+    The pool is started on first use and again after a fork, since the
+    parent's worker processes can't be shared. If a worker dies the pool
+    is broken for good: it's dropped, the hash in flight raises
+    HasherBusy and the next one starts a new pool.
+    """
+
+    def __init__(self, app=None):
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        # Running average of verify() time, which reject() imitates.
+        self.verify_seconds = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config["PASSWORD_HASH_METHOD"]
+        self.workers = app.config["PASSWORD_HASH_WORKERS"]
+        self.niceness = app.config.get("PASSWORD_HASH_NICE", 0)
+        self.timeout = app.config.get("PASSWORD_HASH_TIMEOUT", 30)
+        self.slots = threading.BoundedSemaphore(
+            max(self.workers, 1) + app.config["PASSWORD_HASH_QUEUE"])
+        self.dummy_hash = None
+        # Hash prefix PASSWORD_HASH_METHOD expands to, e.g. "scrypt" to
+        # "scrypt:32768:8:1"; worked out on first use.
+        self.prefix = None
+        app.extensions["passwords"] = self
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context(START_METHOD),
+                    initializer=_lower_priority, initargs=(self.niceness,))
+                self.pid = os.getpid()
+            return self.executor
+
+    def _discard(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        if not self.workers:
+            try:
+                return function(*args)
+            finally:
+                self.slots.release()
+
+        executor = self._executor()
+        try:
+            future = executor.submit(function, *args)
+        except BrokenProcessPool:
+            self.slots.release()
+            self._discard(executor)
+            raise HasherBusy()
+        except BaseException:
+            self.slots.release()
+            raise
+        # The slot is held until the hash finishes, even if we stop waiting.
+        future.add_done_callback(lambda future: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise HasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        start = time.perf_counter()
+        valid = self._run(check_password_hash, pwhash, password)
+        elapsed = time.perf_counter() - start
+        if self.verify_seconds is None:
+            self.verify_seconds = elapsed
+        else:
+            self.verify_seconds += (elapsed - self.verify_seconds) * 0.2
+        return valid
+
+    def needs_rehash(self, pwhash):
+        """Whether `pwhash` was made with a different method or cost.
+
+        The first call hashes once to learn werkzeug's full method string,
+        so like hash() it can raise HasherBusy.
+        """
+        if self.prefix is None:
+            self.prefix = self.hash("").split("$", 1)[0]
+        return pwhash.split("$", 1)[0] != self.prefix
+
+    def reject(self):
+        """Take as long as a failed verify() without doing the hashing.
+
+        Used for unknown usernames so response times don't tell them apart
+        from wrong passwords. Raises HasherBusy whenever verify() would.
+        """
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        self.slots.release()
+
+        if self.verify_seconds is None:
+            if self.dummy_hash is None:
+                self.dummy_hash = self.hash(secrets.token_hex(16))
+            self.verify(self.dummy_hash, "")
+        else:
+            time.sleep(self.verify_seconds)
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,109 @@
+import re
+from sqlalchemy import Float, Integer, text
+from catalog import (InvalidQuery, apply_filters, decode_cursor, encode_cursor,
+                     keyset_filter, page_size)
+from models import db, Product
+
+
+FTS_TABLE = "product_fts"
+
+
+class SearchUnavailable(Exception):
+    """Full-text search needs SQLite's FTS5; other backends have no index."""
+
+# External-content FTS5 index over product; the triggers keep it in sync
+# with every insert, update and delete, including those in checkout.
+SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        title, description, category,
+        content='product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON product BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, description, category)
+        VALUES (new.id, new.title, new.description, new.category);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description, category)
+        VALUES ('delete', old.id, old.title, old.description, old.category);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE ON product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description, category)
+        VALUES ('delete', old.id, old.title, old.description, old.category);
+        INSERT INTO {FTS_TABLE}(rowid, title, description, category)
+        VALUES (new.id, new.title, new.description, new.category);
+    END""",
+]
+
+# bm25 weights title matches above category and category above description;
+# lower is better.
+MATCH_SQL = f"""SELECT rowid AS id, bm25({FTS_TABLE}, 10.0, 1.0, 4.0) AS rank
+    FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :q"""
+
+
+def create_search_index():
+    """Create the FTS5 table and triggers, indexing existing products.
+
+    Must run inside an app context after db.create_all(). A no-op on
+    backends other than SQLite.
+    """
+    if db.engine.dialect.name != "sqlite":
+        return
+    with db.engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+            {"name": FTS_TABLE}).first()
+        for statement in SCHEMA:
+            conn.execute(text(statement))
+        if exists is None:
+            conn.execute(text(
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+
+def match_expression(q):
+    """Turn free text into an FTS5 query.
+
+    Every word is quoted so user input can't inject FTS5 syntax, and the
+    last word is a prefix match so partial input works for type-ahead.
+    """
+    words = re.findall(r"\w+", q or "")
+    if not words:
+        raise InvalidQuery("Search query must contain a word")
+    terms = ['"%s"' % word for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_page(args):
+    """Return one page of product rows matching `args['q']`, best first.
+
+    Accepts the same filters, `limit` and `cursor` as the catalog; the
+    cursor is keyed on (bm25 rank, id). Rows hold Product.view_columns()
+    followed by the rank. Raises SearchUnavailable on backends other than
+    SQLite.
+    """
+    if db.engine.dialect.name != "sqlite":
+        raise SearchUnavailable()
+    limit = page_size(args)
+    matches = text(MATCH_SQL) \
+        .bindparams(q=match_expression(args.get("q"))) \
+        .columns(id=Integer, rank=Float).subquery()
+
+    query = db.session.query(*Product.view_columns(), matches.c.rank) \
+        .join(matches, matches.c.id == Product.id)
+
+    cursor = args.get("cursor")
+    if cursor:
+        values = decode_cursor(cursor, (float, int))
+        query = query.filter(
+            keyset_filter([matches.c.rank, Product.id], values, False))
+
+    query = apply_filters(query, args)
+    rows = query.order_by(matches.c.rank, Product.id).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1].rank, rows[-1].id])
+
+    return rows, next_cursor
@@ -0,0 +1,59 @@
+from functools import partial
+from itertools import islice
+from flask import Response, current_app, request, stream_with_context
+
+
+# Rows fetched from the database cursor, and items written to the client,
+# per step.
+STREAM_BATCH = 1000
+
+NDJSON = "application/x-ndjson"
+
+
+def stream_format():
+    """The streamed format the request asked for, or None to paginate.
+
+    `?stream=json` streams one JSON array, `?stream=ndjson` or an
+    `Accept: application/x-ndjson` header streams one object per line.
+    """
+    stream = request.args.get("stream")
+    if stream in ("json", "ndjson"):
+        return stream
+    if request.accept_mimetypes.best == NDJSON:
+        return "ndjson"
+    return None
+
+
+def batched(rows, size=STREAM_BATCH):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def stream_response(batches, format):
+    """Stream lists of serialized items as a JSON array or NDJSON.
+
+    `batches` is consumed lazily while the response is written, so only
+    one batch is held in memory at a time. It runs inside the request
+    context, so it may keep reading from the database session.
+    """
+    dumps = partial(current_app.json.dumps, separators=(",", ":"))
+
+    def json_array():
+        separator = "["
+        for batch in batches:
+            yield separator + ",".join(map(dumps, batch))
+            separator = ","
+        yield "[]\n" if separator == "[" else "]\n"
+
+    def ndjson():
+        for batch in batches:
+            yield "".join(dumps(item) + "\n" for item in batch)
+
+    if format == "ndjson":
+        return Response(stream_with_context(ndjson()), mimetype=NDJSON)
+    return Response(stream_with_context(json_array()),
+                    mimetype="application/json")
@@ -0,0 +1,9 @@
+from benchmarks.checkout import race
+
+
+def test_racing_buyers_sell_each_product_once():
+    results, sold = race(8, 5)
+    assert len(results) == 8, results
+    assert results.count("ok") == 1, results
+    assert results.count("conflict") == 7, results
+    assert sold == 5
@@ -0,0 +1,6 @@
+from benchmarks import order_history
+
+
+def test_get_orders_statements_do_not_grow_with_history():
+    counts = order_history.check((10, 100, 1000))
+    assert len(set(counts.values())) == 1, counts